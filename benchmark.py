@@ -0,0 +1,327 @@
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import tracemalloc
+import argparse
+import datetime
+
+import numpy as np
+
+from modules import utils
+from modules.memory.associate import rerank_scores
+from modules.storage.ivf import IVFIndex, normalize
+from modules.storage.quantize import QuantizedVectors, PRECISIONS
+
+
+retrieve_config = {
+    "recency_decay": 0.995,
+    "recency_weight": 0.5,
+    "relevance_weight": 3,
+    "importance_weight": 2,
+}
+
+
+class Node:
+    def __init__(self, id_, score, metadata):
+        self.id_ = id_
+        self.score = score
+        self.metadata = metadata
+
+
+# 原有的逐節點重排序實現，作為對照基準
+def rerank_reference(nodes, config, retrieve_max):
+    def _normalize(data, factor=1, t_min=0, t_max=1):
+        min_val, max_val = min(data), max(data)
+        diff = max_val - min_val
+        if diff == 0:
+            return [(t_max - t_min) * factor / 2 for _ in data]
+        return [(d - min_val) * (t_max - t_min) * factor / diff + t_min for d in data]
+
+    nodes = sorted(
+        nodes, key=lambda n: utils.to_date(n.metadata["access"]), reverse=True
+    )
+    fac = config["recency_decay"]
+    recency_scores = _normalize(
+        [fac**i for i in range(1, len(nodes) + 1)], config["recency_weight"]
+    )
+    relevance_scores = _normalize([n.score for n in nodes], config["relevance_weight"])
+    importance_scores = _normalize(
+        [n.metadata["poignancy"] for n in nodes], config["importance_weight"]
+    )
+    final_scores = {
+        n.id_: r1 + r2 + i
+        for n, r1, r2, i in zip(nodes, recency_scores, relevance_scores, importance_scores)
+    }
+    nodes = sorted(nodes, key=lambda n: final_scores[n.id_], reverse=True)
+    return nodes[:retrieve_max]
+
+
+# 生成隨機記憶：訪問時間按分鐘取值（存在相同時間），相關度與重要度隨機
+def create_memory(num, seed=0):
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 2, 13, 9, 30)
+    access, scores, poignancy, nodes = [], [], [], []
+    for i in range(num):
+        date = start - datetime.timedelta(minutes=rng.randint(0, num // 4 + 10))
+        score, poig = rng.random(), rng.randint(1, 10)
+        metadata = {"access": date.strftime("%Y%m%d-%H:%M:%S"), "poignancy": poig}
+        nodes.append(Node("node_" + str(i), score, metadata))
+        access.append(int((date - datetime.datetime(1970, 1, 1)).total_seconds()))
+        scores.append(score)
+        poignancy.append(poig)
+    return nodes, np.array(access), np.array(scores), np.array(poignancy)
+
+
+def timeit(func, repeat):
+    costs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        costs.append(time.perf_counter() - start)
+    return result, min(costs)
+
+
+def bench_rerank(args):
+    for num in args.nodes:
+        nodes, access, scores, poignancy = create_memory(num, args.seed)
+        expected, ref_cost = timeit(
+            lambda: rerank_reference(nodes, retrieve_config, args.retrieve_max),
+            args.repeat,
+        )
+        order, cost = timeit(
+            lambda: rerank_scores(
+                access, scores, poignancy, retrieve_config, args.retrieve_max
+            ),
+            args.repeat,
+        )
+        same = [n.id_ for n in expected] == [nodes[i].id_ for i in order.tolist()]
+        print(
+            "rerank nodes: {}, retrieve_max: {}, reference: {:.2f}ms, vectorized: {:.2f}ms"
+            ", speedup: {:.1f}x, identical: {}".format(
+                num, args.retrieve_max, ref_cost * 1000, cost * 1000, ref_cost / cost, same
+            )
+        )
+
+
+# 生成單位向量模擬文本嵌入：每條記憶混合幾個隨機話題並加上噪聲，查詢為新取樣的同分佈向量
+def create_vectors(num, dim, queries, seed=0, chunk=65536):
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((max(num // 100, 16), dim), dtype=np.float32)
+
+    def _sample(size):
+        mixed = rng.integers(0, len(topics), (size, 3))
+        weights = rng.dirichlet([1, 1, 1], size).astype(np.float32)
+        vectors = np.einsum("nk,nkd->nd", weights, topics[mixed])
+        noise = rng.standard_normal((size, dim), dtype=np.float32)
+        return normalize(vectors + noise * 0.5)
+
+    vectors = np.zeros((num, dim), dtype=np.float32)
+    for start in range(0, num, chunk):
+        vectors[start : start + chunk] = _sample(min(chunk, num - start))
+    return vectors, _sample(queries)
+
+
+def top_k(scores, k):
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+# 只對查詢所探測的倒排列表中的記憶計算相似度
+def search_ann(ann, vectors, query, k, nprobe):
+    probed = ann.probe(query[None], nprobe)[0]
+    rows = np.flatnonzero(probed[ann.lists(slice(None))])
+    return rows[top_k(vectors[rows] @ query, k)]
+
+
+def bench_ann(args):
+    for num in args.nodes:
+        vectors, queries = create_vectors(num, args.dim, args.queries, args.seed)
+        exact, cost = [], 0
+        for query in queries:
+            result, q_cost = timeit(
+                lambda: top_k(vectors @ query, args.retrieve_max), args.repeat
+            )
+            exact.append(set(result.tolist()))
+            cost += q_cost
+        print(
+            "ann nodes: {}, dim: {}, exact: {:.2f}ms".format(
+                num, args.dim, cost * 1000 / len(queries)
+            )
+        )
+        ann = IVFIndex(nlist=args.nlist, min_nodes=0)
+        _, train_cost = timeit(lambda: ann.train(vectors), 1)
+        print(
+            "  train nlist: {}, {:.2f}s".format(len(ann.centroids), train_cost)
+        )
+        for nprobe in args.nprobe:
+            recall, cost = 0, 0
+            for query, expected in zip(queries, exact):
+                result, q_cost = timeit(
+                    lambda: search_ann(ann, vectors, query, args.retrieve_max, nprobe),
+                    args.repeat,
+                )
+                recall += len(expected & set(result.tolist())) / len(expected)
+                cost += q_cost
+            print(
+                "  nprobe: {}, ivf: {:.2f}ms, recall@{}: {:.3f}".format(
+                    nprobe, cost * 1000 / len(queries), args.retrieve_max,
+                    recall / len(queries),
+                )
+            )
+        # 增量插入與刪除（刪除時以最後一行填補）
+        extra, _ = create_vectors(1000, args.dim, 1, args.seed + 1)
+        _, add_cost = timeit(lambda: ann.add(num, extra), 1)
+        _, remove_cost = timeit(lambda: [ann.remove(r) for r in range(1000)], 1)
+        print(
+            "  insert 1000: {:.2f}ms, delete 1000: {:.2f}ms".format(
+                add_cost * 1000, remove_cost * 1000
+            )
+        )
+
+
+# 讀取存檔中記錄的記憶向量，支持numpy與llama兩種索引的存儲格式
+def load_memory(folder):
+    vectors = []
+    for root, _, files in os.walk(folder):
+        if "numpy_index.json" in files:
+            data = utils.load_dict(os.path.join(root, "numpy_index.json"))
+            embeddings = {}
+            for partition in data["partitions"].values():
+                file, size = os.path.join(root, partition["file"]), len(partition["nodes"])
+                precision = partition.get("precision", "float32")
+                if precision == "float32":
+                    stored = np.load(file)
+                else:
+                    stored = QuantizedVectors.load(file, size, precision, exact=True)
+                    stored = (stored.exact or stored)[slice(None)]
+                embeddings.update(zip([n[0] for n in partition["nodes"]], stored))
+            segments = os.path.join(root, "numpy_segments.jsonl")
+            if os.path.exists(segments):
+                with open(segments, "r", encoding="utf-8") as f:
+                    for line in f:
+                        segment = json.loads(line)
+                        for added in segment["add"]:
+                            embeddings[added["id"]] = added["embedding"]
+                        for node_id in segment["remove"]:
+                            embeddings.pop(node_id, None)
+            if embeddings:
+                vectors.append(np.array(list(embeddings.values()), dtype=np.float32))
+        elif "default__vector_store.json" in files:
+            data = utils.load_dict(os.path.join(root, "default__vector_store.json"))
+            embeddings = dict(data["embedding_dict"])
+            segments = os.path.join(root, "segments.jsonl")
+            if os.path.exists(segments):
+                with open(segments, "r", encoding="utf-8") as f:
+                    for line in f:
+                        segment = json.loads(line)
+                        for added in segment["add"]:
+                            embeddings[added["node"]["id_"]] = added["embedding"]
+                        for node_id in segment["remove"]:
+                            embeddings.pop(node_id, None)
+            if embeddings:
+                vectors.append(np.array(list(embeddings.values()), dtype=np.float32))
+    vectors = [v for v in vectors if len(v)]
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return normalize(np.concatenate(vectors).astype(np.float32))
+
+
+def search_stored(stored, query, k, rerank):
+    rows = np.arange(len(stored))
+    scores = stored.dot(rows, query[None])[:, 0]
+    if not rerank:
+        return top_k(scores, k)
+    top = top_k(scores, k * rerank)
+    exact = stored.exact_dot(top, query[None])[:, 0]
+    return top[top_k(exact, k)]
+
+
+def bench_precision(args):
+    if args.memory:
+        memory = load_memory(args.memory)
+        rng = np.random.default_rng(args.seed)
+        held = rng.permutation(len(memory))[: args.queries]
+        rest = np.setdiff1d(np.arange(len(memory)), held)
+        datasets = [("memory", memory[rest], memory[held])]
+    else:
+        datasets = [
+            ("synthetic", *create_vectors(num, args.dim, args.queries, args.seed))
+            for num in args.nodes
+        ]
+    for name, vectors, queries in datasets:
+        k = min(args.retrieve_max, len(vectors))
+        if not len(queries) or not k:
+            print("{}: no memory to test".format(name))
+            continue
+        exact, cost = [], 0
+        for query in queries:
+            result, q_cost = timeit(lambda: top_k(vectors @ query, k), args.repeat)
+            exact.append(set(result.tolist()))
+            cost += q_cost
+        dim = vectors.shape[1]
+        print(
+            "{} nodes: {}, dim: {}, float32: {:.2f}ms, {} bytes/vector".format(
+                name, len(vectors), dim, cost * 1000 / len(queries), dim * 4
+            )
+        )
+        for precision in PRECISIONS:
+            for rerank in args.rerank:
+                stored = QuantizedVectors.create(precision, exact=rerank > 0)
+                stored.append(vectors)
+                # 存檔後重新載入，與記憶索引相同：編碼與float32向量都映射自文件
+                folder = tempfile.mkdtemp()
+                path = os.path.join(folder, "vectors.npy")
+                stored.save(path)
+                stored = QuantizedVectors.load(path, len(vectors), precision, exact=rerank > 0)
+                recall, cost = 0, 0
+                for query, expected in zip(queries, exact):
+                    result, q_cost = timeit(
+                        lambda: search_stored(stored, query, k, rerank), args.repeat
+                    )
+                    recall += len(expected & set(result.tolist())) / len(expected)
+                    cost += q_cost
+                # 單次查詢新分配的記憶體峰值，不含映射的文件
+                tracemalloc.start()
+                search_stored(stored, queries[0], k, rerank)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                del stored
+                shutil.rmtree(folder)
+                size = dim * np.dtype(PRECISIONS[precision]).itemsize
+                size += 4 if precision == "int8" else 0
+                print(
+                    "  {} rerank: {}, {:.2f}ms, recall@{}: {:.3f}, {} bytes/vector scored{}, peak: {:.1f}MB".format(
+                        precision, rerank, cost * 1000 / len(queries), k,
+                        recall / len(queries), size,
+                        " (+{} float32 on disk, {} rows read)".format(dim * 4, k * rerank) if rerank else "",
+                        peak / 2**20,
+                    )
+                )
+
+
+parser = argparse.ArgumentParser(description="Micro benchmarks of the agent memory")
+parser.add_argument("target", type=str, nargs="?", default="rerank", choices=["rerank", "ann", "precision"], help="The benchmark to run")
+parser.add_argument("--nodes", type=int, nargs="+", default=[10000, 100000], help="The number of memory nodes")
+parser.add_argument("--retrieve_max", type=int, default=30, help="The number of nodes to keep")
+parser.add_argument("--repeat", type=int, default=3, help="Repeat and report the best time")
+parser.add_argument("--dim", type=int, default=1024, help="The dimension of the embeddings (ann)")
+parser.add_argument("--queries", type=int, default=20, help="The number of queries (ann)")
+parser.add_argument("--nlist", type=int, default=0, help="The number of inverted lists, 0 for sqrt(nodes) (ann)")
+parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64], help="The number of probed lists (ann)")
+parser.add_argument("--rerank", type=int, nargs="+", default=[0, 4], help="Re-score rerank * k candidates exactly, 0 to disable (precision)")
+parser.add_argument("--memory", type=str, default="", help="Folder of recorded memories, e.g. results/checkpoints/<name>/storage (precision)")
+parser.add_argument("--seed", type=int, default=0, help="The random seed of the memory")
+args = parser.parse_args()
+
+
+if __name__ == "__main__":
+    if args.target == "rerank":
+        bench_rerank(args)
+    elif args.target == "ann":
+        bench_ann(args)
+    elif args.target == "precision":
+        bench_precision(args)
@@ -5,6 +5,8 @@ import collections
 from datetime import datetime
 
 from modules.maze import Maze
+from modules import utils
+from modules.storage.run_store import open_run_store
 from start import personas
 
 file_markdown = "simulation.md"
@@ -13,14 +15,64 @@ file_movement = "movement.json"
 frames_per_step = 60  # 每個step包含的幀數
 
 
+# 運行的步數，從清單中讀取，沒有清單的舊運行需掃描存檔文件
+def count_steps(checkpoints_folder):
+    manifest = utils.load_manifest(checkpoints_folder)
+    if manifest:
+        return manifest["step"]
+    return len(utils.list_checkpoints(checkpoints_folder))
+
+
+# 打開run.db，僅當其記錄了運行的每一步時使用（例如斷點恢复時才啟用存儲，run.db只有後面的步數）
+def open_store(checkpoints_folder):
+    store = open_run_store(checkpoints_folder)
+    if store is None:
+        return None
+    if not store.covers(count_steps(checkpoints_folder)):
+        store.close()
+        return None
+    return store
+
+
+# 依次讀取所有存檔數據，run.db完整時直接查詢，否則解析存檔文件（差異存檔會應用到最近的完整存檔上）
+def load_steps(checkpoints_folder):
+    store = open_store(checkpoints_folder)
+    if store is not None:
+        try:
+            yield from store.iter_steps()
+        finally:
+            store.close()
+        return
+
+    for _, config in utils.load_checkpoints(checkpoints_folder):
+        yield config
+
+
+# 讀取對話數據，run.db完整時直接查詢
+def load_conversation(checkpoints_folder):
+    store = open_store(checkpoints_folder)
+    if store is not None:
+        try:
+            return store.get_conversation()
+        finally:
+            store.close()
+
+    return utils.load_conversation(checkpoints_folder)
+
+
 # 從存檔文件中讀取stride
-def get_stride(json_files):
-    if len(json_files) < 1:
+def get_stride(checkpoints_folder):
+    store = open_store(checkpoints_folder)
+    if store is not None:
+        try:
+            config = store.last_step()
+        finally:
+            store.close()
+    else:
+        config = utils.load_checkpoint(checkpoints_folder)
+    if config is None:
         return 1
 
-    with open(json_files[-1], "r", encoding="utf-8") as f:
-        config = json.load(f)
-
     return config["stride"]
 
 
@@ -63,15 +115,7 @@ def extract_interaction_data(checkpoints_folder):
     object_interactions = collections.defaultdict(int)
     location_interactions = collections.defaultdict(int)
     
-    conversation_file = "conversation.json"
-    files = sorted(os.listdir(checkpoints_folder))
-    json_files = [f for f in files if f.endswith(".json") and f != conversation_file]
-    
-    for file_name in json_files:
-        file_path = os.path.join(checkpoints_folder, file_name)
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            
+    for data in load_steps(checkpoints_folder):
         for agent_name, agent_data in data.get("agents", {}).items():
             action = agent_data.get("action", {})
             
@@ -97,24 +141,14 @@ def extract_interaction_data(checkpoints_folder):
 def generate_movement(checkpoints_folder, compressed_folder, compressed_file):
     movement_file = os.path.join(compressed_folder, compressed_file)
 
-    conversation_file = "conversation.json"
-    conversation = {}
-    if os.path.exists(os.path.join(checkpoints_folder, conversation_file)):
-        with open(os.path.join(checkpoints_folder, conversation_file), "r", encoding="utf-8") as f:
-            conversation = json.load(f)
-
-    files = sorted(os.listdir(checkpoints_folder))
-    json_files = list()
-    for file_name in files:
-        if file_name.endswith(".json") and file_name != conversation_file:
-            json_files.append(os.path.join(checkpoints_folder, file_name))
+    conversation = load_conversation(checkpoints_folder)
 
     persona_init_pos = dict()
     all_movement = dict()
     all_movement["description"] = dict()
     all_movement["conversation"] = dict()
 
-    stride = get_stride(json_files)
+    stride = get_stride(checkpoints_folder)
     sec_per_step = stride
 
     result = {
@@ -133,89 +167,87 @@ def generate_movement(checkpoints_folder, compressed_folder, compressed_file):
         json_data = json.load(f)
         maze = Maze(json_data, None)
 
-    for file_name in json_files:
-        # 依次讀取所有存檔文件
-        with open(file_name, "r", encoding="utf-8") as f:
-            json_data = json.load(f)
-            step = json_data["step"]
-            agents = json_data["agents"]
-
-            # 保存回放的起始時間
-            if len(result["start_datetime"]) < 1:
-                t = datetime.strptime(json_data["time"], "%Y%m%d-%H:%M")
-                result["start_datetime"] = t.isoformat()
-
-            # 遍歷單個存檔文件中的所有Agent
-            for agent_name, agent_data in agents.items():
-                # 插入第0幀
-                if step == 1:
-                    insert_frame0(persona_init_pos, all_movement, agent_name)
-
-                source_coord = last_location.get(agent_name, all_movement["0"][agent_name])["movement"]
-                target_coord = agent_data["coord"]
-                location = get_location(agent_data["action"]["event"]["address"])
-                if location is None:
-                    location = last_location.get(agent_name, all_movement["0"][agent_name])["location"]
-                    path = [source_coord]
+    # 依次讀取所有存檔文件
+    for json_data in load_steps(checkpoints_folder):
+        step = json_data["step"]
+        agents = json_data["agents"]
+
+        # 保存回放的起始時間
+        if len(result["start_datetime"]) < 1:
+            t = datetime.strptime(json_data["time"], "%Y%m%d-%H:%M")
+            result["start_datetime"] = t.isoformat()
+
+        # 遍歷單個存檔文件中的所有Agent
+        for agent_name, agent_data in agents.items():
+            # 插入第0幀
+            if step == 1:
+                insert_frame0(persona_init_pos, all_movement, agent_name)
+
+            source_coord = last_location.get(agent_name, all_movement["0"][agent_name])["movement"]
+            target_coord = agent_data["coord"]
+            location = get_location(agent_data["action"]["event"]["address"])
+            if location is None:
+                location = last_location.get(agent_name, all_movement["0"][agent_name])["location"]
+                path = [source_coord]
+            else:
+                path = maze.find_path(source_coord, target_coord)
+
+            had_conversation = False
+            step_conversation = ""
+            persons_in_conversation = []
+            step_time = json_data["time"]
+            if step_time in conversation.keys():
+                for chats in conversation[step_time]:
+                    for persons, chat in chats.items():
+                        persons_in_conversation.append(persons.split(" @ ")[0].split(" -> "))
+                        step_conversation += f"\n地點：{persons.split(' @ ')[1]}\n\n"
+                        for c in chat:
+                            agent = c[0]
+                            text = c[1]
+                            step_conversation += f"{agent}：{text}\n"
+
+            for i in range(frames_per_step):
+                moving = len(path) > 1
+                if len(path) > 0:
+                    movement = list(path[0])
+                    path = path[1:]
+                    if agent_name not in last_location.keys():
+                        last_location[agent_name] = dict()
+                    last_location[agent_name]["movement"] = movement
+                    last_location[agent_name]["location"] = location
                 else:
-                    path = maze.find_path(source_coord, target_coord)
-
-                had_conversation = False
-                step_conversation = ""
-                persons_in_conversation = []
-                step_time = json_data["time"]
-                if step_time in conversation.keys():
-                    for chats in conversation[step_time]:
-                        for persons, chat in chats.items():
-                            persons_in_conversation.append(persons.split(" @ ")[0].split(" -> "))
-                            step_conversation += f"\n地點：{persons.split(' @ ')[1]}\n\n"
-                            for c in chat:
-                                agent = c[0]
-                                text = c[1]
-                                step_conversation += f"{agent}：{text}\n"
-
-                for i in range(frames_per_step):
-                    moving = len(path) > 1
-                    if len(path) > 0:
-                        movement = list(path[0])
-                        path = path[1:]
-                        if agent_name not in last_location.keys():
-                            last_location[agent_name] = dict()
-                        last_location[agent_name]["movement"] = movement
-                        last_location[agent_name]["location"] = location
-                    else:
-                        movement = None
-
-                    if moving:
-                        action = f"前往 {location}"
-                    elif movement is not None:
-                        action = agent_data["action"]["event"]["describe"]
-                        if len(action) < 1:
-                            action = f'{agent_data["action"]["event"]["predicate"]}{agent_data["action"]["event"]["object"]}'
-
-                        # 判斷該存檔文件中當前Agent是否有新的對話（用於設置圖標）
-                        for persons in persons_in_conversation:
-                            if agent_name in persons:
-                                had_conversation = True
-                                break
-
-                        # 針對睡覺和對話設置圖標
-                        if "睡覺" in action:
-                            action = "😴 " + action
-                        elif had_conversation:
-                            action = "💬 " + action
-
-                    step_key = "%d" % ((step-1) * frames_per_step + 1 + i)
-                    if step_key not in all_movement.keys():
-                        all_movement[step_key] = dict()
-
-                    if movement is not None:
-                        all_movement[step_key][agent_name] = {
-                            "location": location,
-                            "movement": movement,
-                            "action": action,
-                        }
-                all_movement["conversation"][step_time] = step_conversation
+                    movement = None
+
+                if moving:
+                    action = f"前往 {location}"
+                elif movement is not None:
+                    action = agent_data["action"]["event"]["describe"]
+                    if len(action) < 1:
+                        action = f'{agent_data["action"]["event"]["predicate"]}{agent_data["action"]["event"]["object"]}'
+
+                    # 判斷該存檔文件中當前Agent是否有新的對話（用於設置圖標）
+                    for persons in persons_in_conversation:
+                        if agent_name in persons:
+                            had_conversation = True
+                            break
+
+                    # 針對睡覺和對話設置圖標
+                    if "睡覺" in action:
+                        action = "😴 " + action
+                    elif had_conversation:
+                        action = "💬 " + action
+
+                step_key = "%d" % ((step-1) * frames_per_step + 1 + i)
+                if step_key not in all_movement.keys():
+                    all_movement[step_key] = dict()
+
+                if movement is not None:
+                    all_movement[step_key][agent_name] = {
+                        "location": location,
+                        "movement": movement,
+                        "action": action,
+                    }
+            all_movement["conversation"][step_time] = step_conversation
     object_interactions, location_interactions = extract_interaction_data(checkpoints_folder)
     
     # 轉換為前端需要的格式
@@ -242,11 +274,7 @@ def generate_movement(checkpoints_folder, compressed_folder, compressed_file):
 def generate_report(checkpoints_folder, compressed_folder, compressed_file):
     last_state = dict()
 
-    conversation_file = "conversation.json"
-    conversation = {}
-    if os.path.exists(os.path.join(checkpoints_folder, conversation_file)):
-        with open(os.path.join(checkpoints_folder, conversation_file), "r", encoding="utf-8") as f:
-            conversation = json.load(f)
+    conversation = load_conversation(checkpoints_folder)
 
     def extract_description():
         markdown_content = "# 基礎人設\n\n"
@@ -304,16 +332,9 @@ def generate_report(checkpoints_folder, compressed_folder, compressed_file):
         return markdown_content
 
     all_markdown_content = extract_description()
-    files = sorted(os.listdir(checkpoints_folder))
-    for file_name in files:
-        if (not file_name.endswith(".json")) or (file_name == conversation_file):
-            continue
-
-        file_path = os.path.join(checkpoints_folder, file_name)
-        with open(file_path, "r", encoding="utf-8") as f:
-            json_data = json.load(f)
-            content = extract_action(json_data)
-            all_markdown_content += content + "\n\n"
+    for json_data in load_steps(checkpoints_folder):
+        content = extract_action(json_data)
+        all_markdown_content += content + "\n\n"
     with open(f"{compressed_folder}/{compressed_file}", "w", encoding="utf-8") as compressed_file:
         compressed_file.write(all_markdown_content)
 
@@ -4,6 +4,7 @@ import os
 import math
 import random
 import datetime
+import threading
 
 from modules import memory, prompt, utils
 from modules.model.llm_model import create_llm_model
@@ -17,6 +18,10 @@ class Agent:
         self.conversation = conversation
         self._llm = None
         self.logger = logger
+        # held while thinking, or while another agent reacts to this one
+        self.lock = threading.RLock()
+        # (name of the other agent, focus) recorded by a deferred think
+        self.reaction = None
 
         # agent config
         self.percept_config = config["percept"]
@@ -26,8 +31,12 @@ class Agent:
         # memory
         self.spatial = memory.Spatial(**config["spatial"])
         self.schedule = memory.Schedule(**config["schedule"])
+        # snapshot of a resumed game, holds the exact coord, path and index state
+        snapshot = config.get("snapshot")
         self.associate = memory.Associate(
-            os.path.join(config["storage_root"], "associate"), **config["associate"]
+            os.path.join(config["storage_root"], "associate"),
+            **config["associate"],
+            index_state=snapshot["index"] if snapshot else None,
         )
         self.concepts, self.chats = [], config.get("chats", [])
 
@@ -38,6 +47,8 @@ class Agent:
         status = {"poignancy": 0}
         self.status = utils.update_dict(status, config.get("status", {}))
         self.plan = config.get("plan", {})
+        # state of the last think, used to skip idle steps
+        self._idle_state = None
 
         # record
         self.last_record = utils.get_timer().daily_duration()
@@ -45,8 +56,11 @@ class Agent:
         # action and events
         if "action" in config:
             self.action = memory.Action.from_dict(config["action"])
-            tiles = self.maze.get_address_tiles(self.get_event().address)
-            config["coord"] = random.choice(list(tiles))
+            if snapshot:
+                config["coord"], config["path"] = snapshot["coord"], snapshot["path"]
+            else:
+                tiles = self.maze.get_address_tiles(self.get_event().address)
+                config["coord"] = random.choice(list(tiles))
         else:
             tile = self.maze.tile_at(config["coord"])
             address = tile.get_address("game_object", as_list=True)
@@ -113,8 +127,40 @@ class Agent:
         self.logger.debug(utils.block_msg(title, msg))
         return output
 
-    def think(self, status, agents):
+    def think(self, status, agents, defer=False):
+        # memories added during the step are embedded in one batch
+        with self.associate.batch():
+            return self._think(status, agents, defer)
+
+    def react(self, other, agents):
+        """Run the reaction recorded by a deferred think, both agents are locked
+
+        The think has already decided the action of the step, a chat or wait
+        replaces it and only the path and emoji of the plans are updated.
+        Return the names of the agents whose action is revised.
+        """
+
+        (_, focus), action = self.reaction, self.action
+        self.reaction = None
+        with self.associate.batch():
+            chatted = self._chat_with(other, focus)
+            if not chatted:
+                self._wait_other(other, focus)
+        if self.action is action:
+            return []
+        self.update_plan(agents)
+        if not chatted:
+            return [self.name]
+        # a remote agent updates its plan in the shard that owns it
+        other.update_plan(agents)
+        return [self.name, other.name]
+
+    def _think(self, status, agents, defer=False):
         events = self.move(status["coord"], status.get("path"))
+        idle_state = {
+            "action": self.action,
+            "stamp": self.maze.get_scope_stamp(self.coord, self.percept_config),
+        }
         plan, _ = self.make_schedule()
 
         if (plan["describe"] == "sleeping" or "睡" in plan["describe"]) and self.is_awake():
@@ -137,7 +183,7 @@ class Agent:
             )
         if self.is_awake():
             self.percept()
-            self.make_plan(agents)
+            self.make_plan(agents, defer)
             self.reflect()
         else:
             if self.action.finished():
@@ -155,8 +201,57 @@ class Agent:
             "path": self.find_path(agents),
             "emojis": emojis,
         }
+        idle_state["slot"] = self._schedule_slot()
+        self._idle_state = idle_state
         return self.plan
 
+    def update_plan(self, agents):
+        """Update the path and emoji of the plan after the action is revised"""
+
+        self.plan["path"] = self.find_path(agents)
+        if self.action:
+            self.plan.setdefault("emojis", {})[self.name] = {
+                "emoji": self.get_event().emoji,
+                "coord": self.coord,
+            }
+
+    def is_idle(self, status):
+        """Check if nothing changed since the last think, so the plan can be reused"""
+
+        state = self._idle_state
+        if not state or self.path or status.get("path") or self.plan.get("path"):
+            return False
+        if list(status["coord"]) != list(self.coord):
+            return False
+        if self.action is not state["action"] or self.action.finished():
+            return False
+        if self._schedule_slot() != state["slot"]:
+            return False
+        stamp = self.maze.get_scope_stamp(self.coord, self.percept_config)
+        return stamp <= state["stamp"]
+
+    def next_event(self):
+        """The earliest time that the action or schedule of the agent changes"""
+
+        timer = utils.get_timer()
+        now = timer.get_date()
+        # the route of a walking agent is kept in the plan until it arrives
+        if self.path or self.plan.get("path"):
+            return now
+        if self.action.finished() or not self.schedule.scheduled():
+            return now
+        # a new schedule is made at midnight
+        times = [self.action.end, timer.daily_time(24 * 60)]
+        for plan in self.schedule.current_plan():
+            times.append(timer.daily_time(plan["start"] + plan["duration"]))
+        return min([t for t in times if t > now], default=now)
+
+    def _schedule_slot(self):
+        if not self.schedule.scheduled():
+            return None
+        plan, de_plan = self.schedule.current_plan()
+        return plan["idx"], de_plan["start"]
+
     def move(self, coord, path=None):
         events = {}
 
@@ -171,19 +266,20 @@ class Agent:
                 self.maze.update_obj(coord, obj_event)
             return {e: coord for e in tile.get_events()}
 
-        if self.coord and self.coord != coord:
-            tile = self.get_tile()
-            tile.remove_events(subject=self.name)
-            if tile.has_address("game_object"):
-                addr = tile.get_address("game_object")
-                self.maze.update_obj(
-                    self.coord, memory.Event(addr[-1], address=addr)
-                )
-            events.update({e: self.coord for e in tile.get_events()})
-        if not path:
-            events.update(_update_tile(coord))
-        self.coord = coord
-        self.path = path or []
+        with self.maze.lock:
+            if self.coord and self.coord != coord:
+                tile = self.get_tile()
+                tile.remove_events(subject=self.name)
+                if tile.has_address("game_object"):
+                    addr = tile.get_address("game_object")
+                    self.maze.update_obj(
+                        self.coord, memory.Event(addr[-1], address=addr)
+                    )
+                events.update({e: self.coord for e in tile.get_events()})
+            if not path:
+                events.update(_update_tile(coord))
+            self.coord = coord
+            self.path = path or []
 
         return events
 
@@ -285,22 +381,19 @@ class Agent:
                 self.spatial.add_leaf(tile.address)
         events, arena = {}, self.get_tile().get_address("arena")
         # gather events in scope
-        for tile in scope:
-            if not tile.events or tile.get_address("arena") != arena:
-                continue
-            dist = math.dist(tile.coord, self.coord)
-            for event in tile.get_events():
-                if dist < events.get(event, float("inf")):
-                    events[event] = dist
+        with self.maze.lock:
+            for tile in scope:
+                if not tile.events or tile.get_address("arena") != arena:
+                    continue
+                dist = math.dist(tile.coord, self.coord)
+                for event in tile.get_events():
+                    if dist < events.get(event, float("inf")):
+                        events[event] = dist
         events = list(sorted(events.keys(), key=lambda k: events[k]))
         # get concepts
         self.concepts, valid_num = [], 0
         for idx, event in enumerate(events[: self.percept_config["att_bandwidth"]]):
-            recent_nodes = (
-                self.associate.retrieve_events() + self.associate.retrieve_chats()
-            )
-            recent_nodes = set(n.describe for n in recent_nodes)
-            if event.get_describe() not in recent_nodes:
+            if not self.associate.is_recent(event.get_describe(), ("event", "chat")):
                 if event.object == "idle" or event.object == "空閒":
                     node = Concept.from_event(
                         "idle_" + str(idx), "event", event, poignancy=1
@@ -316,8 +409,8 @@ class Agent:
             "{} percept {}/{} concepts".format(self.name, valid_num, len(self.concepts))
         )
 
-    def make_plan(self, agents):
-        if self._reaction(agents):
+    def make_plan(self, agents, defer=False):
+        if self._reaction(agents, defer=defer):
             return
         if self.path:
             return
@@ -416,7 +509,8 @@ class Agent:
                 return True
             return False
 
-        target_tiles = [t for t in target_tiles if not _ignore_target(t)]
+        with self.maze.lock:
+            target_tiles = [t for t in target_tiles if not _ignore_target(t)]
         if not target_tiles:
             return []
         if len(target_tiles) >= 4:
@@ -465,7 +559,7 @@ class Agent:
             start=utils.get_timer().daily_time(de_plan["start"]),
         )
 
-    def _reaction(self, agents=None, ignore_words=None):
+    def _reaction(self, agents=None, ignore_words=None, defer=False):
         focus = None
         ignore_words = ignore_words or ["空閒"]
 
@@ -487,6 +581,13 @@ class Agent:
             return
         other, focus = agents[focus.event.subject], self.associate.get_relation(focus)
 
+        if defer:
+            # the other agent may be thinking, react after all agents finished
+            self.reaction = (other.name, focus)
+            return False
+        return self._react_with(other, focus)
+
+    def _react_with(self, other, focus):
         if self._chat_with(other, focus):
             return True
         if self._wait_other(other, focus):
@@ -583,9 +684,7 @@ class Agent:
                 break
 
         key = utils.get_timer().get_date("%Y%m%d-%H:%M")
-        if key not in self.conversation.keys():
-            self.conversation[key] = []
-        self.conversation[key].append({f"{self.name} -> {other.name} @ {'，'.join(self.get_event().address)}": chats})
+        self.conversation.append(key, {f"{self.name} -> {other.name} @ {'，'.join(self.get_event().address)}": chats})
 
         self.logger.info(
             "{} and {} has chats\n  {}".format(
@@ -646,6 +745,11 @@ class Agent:
         expire=None,
         filling=None,
     ):
+        # near-duplicates are merged into a recent node, without poignancy
+        concept = self.associate.consolidate(e_type, event, create=create, expire=expire)
+        if concept:
+            self.logger.debug("{} merge associate {}".format(self.name, event))
+            return concept
         if event.fit(None, "is", "idle"):
             poignancy = 1
         elif event.fit(None, "此時", "空閒"):
@@ -2,6 +2,7 @@
 
 import os
 import copy
+import random
 
 from modules.utils import GenerativeAgentsMap, GenerativeAgentsKey
 from modules import utils
@@ -12,12 +13,17 @@ from .agent import Agent
 class Game:
     """The Game"""
 
-    def __init__(self, name, static_root, config, conversation, logger=None):
+    def __init__(self, name, static_root, config, conversation, logger=None, snapshot=None):
         self.name = name
         self.static_root = static_root
         self.record_iterval = config.get("record_iterval", 30)
+        self.skip_idle = config.get("simulate", {}).get("skip_idle", False)
         self.logger = logger or utils.IOLogger()
-        self.maze = Maze(self.load_static(config["maze"]["path"]), self.logger)
+        if snapshot:
+            self.maze = snapshot["maze"]
+            self.maze.logger = self.logger
+        else:
+            self.maze = Maze(self.load_static(config["maze"]["path"]), self.logger)
         self.conversation = conversation
         self.agents = {}
         if "agent_base" in config:
@@ -34,15 +40,55 @@ class Game:
             agent_config = utils.update_dict(agent_config, agent)
 
             agent_config["storage_root"] = os.path.join(storage_root, name)
+            if snapshot:
+                agent_config["snapshot"] = snapshot["agents"][name]
             self.agents[name] = Agent(agent_config, self.maze, self.conversation, self.logger)
 
     def get_agent(self, name):
         return self.agents[name]
 
-    def agent_think(self, name, status):
+    def agent_think(self, name, status, defer=False):
+        """Think for an agent, with defer its reaction is recorded for agent_react"""
+
+        agent = self.get_agent(name)
+        with agent.lock:
+            return self._agent_think(agent, status, defer)
+
+    def agent_react(self, name):
+        """Run the deferred reaction of an agent, return the agents revised by it"""
+
         agent = self.get_agent(name)
-        plan = agent.think(status, self.agents)
+        if not agent.reaction:
+            return []
+        other = self.get_agent(agent.reaction[0])
+        # locks are always taken in the order of names, so agents reacting to
+        # each other at the same time can not deadlock
+        first, second = sorted([agent, other], key=lambda a: a.name)
+        with first.lock, second.lock:
+            return agent.react(other, self.agents)
+
+    def react(self, results, executor=None):
+        """Run the reactions deferred by agent_think, and update the plans of results"""
+
+        names = [n for n in sorted(results) if self.get_agent(n).reaction]
+        if executor:
+            futures = [executor.submit(self.agent_react, n) for n in names]
+            changed = [f.result() for f in futures]
+        else:
+            changed = [self.agent_react(n) for n in names]
+        for name in set(n for c in changed for n in c):
+            if name in results:
+                results[name] = dict(results[name], plan=self.get_agent(name).plan)
+        return results
+
+    def _agent_think(self, agent, status, defer=False):
+        name = agent.name
+        if self.skip_idle and agent.is_idle(status):
+            self.logger.info("{} is idle, reuse the last plan".format(name))
+            return {"plan": agent.plan, "info": {"skipped": True}}
+        plan = agent.think(status, self.agents, defer)
         info = {
+            "skipped": False,
             "currently": agent.scratch.currently,
             "associate": agent.associate.abstract(),
             "concepts": {c.node_id: c.abstract() for c in agent.concepts},
@@ -79,11 +125,15 @@ class Game:
             self.logger.info("\n{}\n{}\n".format(utils.split_line(title), agent))
 
 
-def create_game(name, static_root, config, conversation, logger=None):
-    """Create the game"""
+def create_game(name, static_root, config, conversation, logger=None, snapshot=None):
+    """Create the game, restore the world and agents from the snapshot if given"""
 
     utils.set_timer(**config.get("time", {}))
-    GenerativeAgentsMap.set(GenerativeAgentsKey.GAME, Game(name, static_root, config, conversation, logger=logger))
+    utils.set_cassette(**config.get("simulate", {}).get("cassette", {}))
+    utils.set_embed_cache(**config.get("simulate", {}).get("embed_cache", {"enable": False}))
+    if config.get("simulate", {}).get("seed") is not None:
+        random.seed(config["simulate"]["seed"])
+    GenerativeAgentsMap.set(GenerativeAgentsKey.GAME, Game(name, static_root, config, conversation, logger=logger, snapshot=snapshot))
     return GenerativeAgentsMap.get(GenerativeAgentsKey.GAME)
 
 
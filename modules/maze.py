@@ -1,11 +1,15 @@
 """generative_agents.maze"""
 
 import random
-from itertools import product
+import threading
+from itertools import product, count
 
 from modules import utils
 from modules.memory.event import Event
 
+# stamps of tile changes, shared by all tiles
+_stamps = count(1)
+
 
 class Tile:
     def __init__(
@@ -25,9 +29,12 @@ class Tile:
         self.address_map = dict(zip(address_keys[: len(self.address)], self.address))
         self.collision = collision
         self.event_cnt = 0
+        self.stamp = 0
         self._events = {}
         if len(self.address) == 4:
             self.add_event(Event(self.address[-1], address=self.address))
+        # a fresh tile is not changed
+        self.stamp = 0
 
     def abstract(self):
         address = ":".join(self.address)
@@ -55,6 +62,7 @@ class Tile:
         if all(e != event for e in self._events.values()):
             self._events["e_" + str(self.event_cnt)] = event
             self.event_cnt += 1
+            self.touch()
         return event
 
     def remove_events(self, subject=None, event=None):
@@ -66,16 +74,32 @@ class Tile:
                 r_events[tag] = eve
         for r_eve in r_events:
             self._events.pop(r_eve)
+        if r_events:
+            self.touch()
         return r_events
 
     def update_events(self, event, match="subject"):
         u_events = {}
         for tag, eve in self._events.items():
             if match == "subject" and eve.subject == event.subject:
+                if eve != event:
+                    self.touch()
                 self._events[tag] = event
                 u_events[tag] = event
         return u_events
 
+    def set_events(self, events):
+        if list(self._events.values()) == list(events):
+            return
+        self._events = {}
+        for event in events:
+            self._events["e_" + str(self.event_cnt)] = event
+            self.event_cnt += 1
+        self.touch()
+
+    def touch(self):
+        self.stamp = next(_stamps)
+
     def has_address(self, key):
         return key in self.address_map
 
@@ -130,8 +154,24 @@ class Maze:
                 for add in self.tile_at([j, i]).get_addresses():
                     self.address_tiles.setdefault(add, set()).add((j, i))
 
+        # guard tile events when agents think in parallel
+        self.lock = threading.RLock()
         self.logger = logger
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("lock")
+        state["logger"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        # stamps are counted per process, a restored tile is not changed
+        for row in self.tiles:
+            for tile in row:
+                tile.stamp = 0
+
     def find_path(self, src_coord, dst_coord):
         map = [[0 for _ in range(self.maze_width)] for _ in range(self.maze_height)]
         frontier, visited = [src_coord], set()
@@ -190,6 +230,32 @@ class Maze:
             coords = list(product(list(range(*x_range)), list(range(*y_range))))
         return [self.tile_at(c) for c in coords]
 
+    def get_stamp(self):
+        """A stamp that is newer than all changes so far"""
+
+        return next(_stamps)
+
+    def get_events(self, since=0):
+        """Events of the tiles changed after the stamp"""
+
+        with self.lock:
+            return {
+                tile.coord: list(tile.get_events())
+                for row in self.tiles
+                for tile in row
+                if tile.stamp > since
+            }
+
+    def set_events(self, tile_events):
+        with self.lock:
+            for coord, events in tile_events.items():
+                self.tile_at(coord).set_events(events)
+
+    def get_scope_stamp(self, coord, config):
+        """The latest change stamp of tiles in scope"""
+
+        return max(t.stamp for t in self.get_scope(coord, config))
+
     def get_around(self, coord, no_collision=True):
         coords = [
             (coord[0] - 1, coord[1]),
@@ -1,11 +1,12 @@
 """generative_agents.memory.associate"""
 
 import datetime
-from llama_index.core.retrievers import BaseRetriever
+import collections
+import numpy as np
 from llama_index.core.vector_stores import MetadataFilters, ExactMatchFilter
-from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
 
 from modules.storage.index import LlamaIndex
+from modules.storage.numpy_index import NumpyIndex
 from modules import utils
 from .event import Event
 
@@ -24,6 +25,8 @@ class Concept:
         create=None,
         expire=None,
         access=None,
+        count=1,
+        last=None,
     ):
         self.node_id = node_id
         self.node_type = node_type
@@ -37,9 +40,12 @@ class Concept:
         else:
             self.expire = self.create + datetime.timedelta(days=30)
         self.access = utils.to_date(access) if access else self.create
+        # occurrences of the merged near-duplicate events, and the latest one
+        self.count = count
+        self.last = utils.to_date(last) if last else self.create
 
     def abstract(self):
-        return {
+        des = {
             "{}(P.{})".format(self.node_type, self.poignancy): str(self.event),
             "duration": "{} ~ {} (access: {})".format(
                 self.create.strftime("%Y%m%d-%H:%M"),
@@ -47,6 +53,13 @@ class Concept:
                 self.access.strftime("%Y%m%d-%H:%M"),
             ),
         }
+        if self.count > 1:
+            des["occurrence"] = "{} times, {} ~ {}".format(
+                self.count,
+                self.create.strftime("%Y%m%d-%H:%M"),
+                self.last.strftime("%Y%m%d-%H:%M"),
+            )
+        return des
 
     def __str__(self):
         return utils.dump_dict(self.abstract())
@@ -73,51 +86,105 @@ class Concept:
         )
 
 
-class AssociateRetriever(BaseRetriever):
-    def __init__(self, config, *args, **kwargs) -> None:
-        self._config = config
-        self._vector_retriever = VectorIndexRetriever(*args, **kwargs)
-        super().__init__()
+_recency_powers = {}
 
-    def _retrieve(self, query_bundle):
-        """Retrieve nodes given query."""
 
-        nodes = self._vector_retriever.retrieve(query_bundle)
-        if not nodes:
-            return []
-        nodes = sorted(
-            nodes, key=lambda n: utils.to_date(n.metadata["access"]), reverse=True
-        )
-        # get scores
-        fac = self._config["recency_decay"]
-        recency_scores = self._normalize(
-            [fac**i for i in range(1, len(nodes) + 1)], self._config["recency_weight"]
+def recency_powers(decay, num):
+    """Get decay**i for i in 1..num, computed as python floats and cached"""
+
+    powers = _recency_powers.get(decay)
+    if powers is None or len(powers) < num:
+        size = max(num, 2 * len(powers) if powers is not None else 256)
+        powers = np.array([decay**i for i in range(1, size + 1)], dtype=np.float64)
+        _recency_powers[decay] = powers
+    return powers[:num]
+
+
+def normalize_scores(data, factor=1, t_min=0, t_max=1):
+    min_val, max_val = data.min(), data.max()
+    diff = max_val - min_val
+    if diff == 0:
+        return np.full(len(data), (t_max - t_min) * factor / 2)
+    return (data - min_val) * (t_max - t_min) * factor / diff + t_min
+
+
+def rerank_scores(access, scores, poignancy, config, retrieve_max):
+    """Rank nodes by recency, relevance and importance
+
+    Nodes are ordered by access (latest first) to get the recency, then by the
+    final score, both with stable sorts. Return the indices of the top nodes.
+    """
+
+    by_access = np.argsort(-np.asarray(access), kind="stable")
+    num = len(by_access)
+    final = (
+        normalize_scores(
+            recency_powers(config["recency_decay"], num), config["recency_weight"]
         )
-        relevance_scores = self._normalize(
-            [n.score for n in nodes], self._config["relevance_weight"]
+        + normalize_scores(
+            np.asarray(scores, dtype=np.float64)[by_access], config["relevance_weight"]
         )
-        importance_scores = self._normalize(
-            [n.metadata["poignancy"] for n in nodes], self._config["importance_weight"]
+        + normalize_scores(
+            np.asarray(poignancy)[by_access], config["importance_weight"]
         )
-        final_scores = {
-            n.id_: r1 + r2 + i
-            for n, r1, r2, i in zip(
-                nodes, recency_scores, relevance_scores, importance_scores
-            )
-        }
-        # re-rank nodes
-        nodes = sorted(nodes, key=lambda n: final_scores[n.id_], reverse=True)
-        nodes = nodes[: self._config["retrieve_max"]]
-        for n in nodes:
-            n.metadata["access"] = utils.get_timer().get_date("%Y%m%d-%H:%M:%S")
-        return nodes
+    )
+    k = min(retrieve_max, num)
+    if k <= 0:
+        return by_access[:0]
+    if k < num:
+        # keep all the ties of the k-th score, so the stable order is preserved
+        kth = np.partition(-final, k - 1)[k - 1]
+        candidates = np.flatnonzero(-final <= kth)
+    else:
+        candidates = np.arange(num)
+    order = candidates[np.argsort(-final[candidates], kind="stable")][:k]
+    return by_access[order]
+
+
+class RecentMemory:
+    """Descriptions of the latest nodes of each node type
+
+    Each node type keeps a ring of (node_id, describe) of its latest nodes and a
+    counter of the descriptions, so checking a description is O(1).
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._rings = {}
+        self._counts = {}
+
+    def add(self, node_type, node_id, describe):
+        ring = self._rings.setdefault(node_type, collections.deque())
+        counts = self._counts.setdefault(node_type, collections.Counter())
+        ring.appendleft((node_id, describe))
+        counts[describe] += 1
+        if len(ring) > self._size:
+            _, dropped = ring.pop()
+            counts[dropped] -= 1
+            if not counts[dropped]:
+                del counts[dropped]
+
+    def reset(self, node_type, nodes):
+        """Reset the ring with (node_id, describe) of the latest nodes, latest first"""
+
+        self._rings[node_type] = collections.deque()
+        self._counts[node_type] = collections.Counter()
+        for node_id, describe in reversed(nodes[: self._size]):
+            self.add(node_type, node_id, describe)
+
+    def node_ids(self, node_type):
+        return [node_id for node_id, _ in self._rings.get(node_type, [])]
 
-    def _normalize(self, data, factor=1, t_min=0, t_max=1):
-        min_val, max_val = min(data), max(data)
-        diff = max_val - min_val
-        if diff == 0:
-            return [(t_max - t_min) * factor / 2 for _ in data]
-        return [(d - min_val) * (t_max - t_min) * factor / diff + t_min for d in data]
+    def contains(self, describe, node_types):
+        return any(describe in self._counts.get(t, {}) for t in node_types)
+
+
+def create_index(index_type="llama", **kwargs):
+    if index_type == "llama":
+        return LlamaIndex(**kwargs)
+    if index_type == "numpy":
+        return NumpyIndex(**kwargs)
+    raise NotImplementedError("index type {} is not supported".format(index_type))
 
 
 class Associate:
@@ -132,13 +199,35 @@ class Associate:
         recency_weight=0.5,
         relevance_weight=3,
         importance_weight=2,
+        compact_segments=50,
+        index=None,
+        consolidate=None,
+        persist_access=False,
         memory=None,
+        index_state=None,
     ):
-        self._index_config = {"embedding": embedding, "path": path}
-        self._index = LlamaIndex(**self._index_config)
+        self._index_config = {
+            "embedding": embedding,
+            "path": path,
+            "compact_segments": compact_segments,
+        }
+        index = dict(index or {})
+        index_type = index.pop("type", "llama")
+        self._index = create_index(
+            index_type, **self._index_config, **index, state=index_state
+        )
         self.memory = memory or {"event": [], "thought": [], "chat": []}
-        self.cleanup_index()
         self.retention = retention
+        # concepts by node id, kept in sync with the removals
+        self._concepts = {}
+        # write the access dates of retrieved nodes to the index and the concepts,
+        # which makes recently retrieved nodes rank higher in later retrievals
+        self._persist_access = persist_access
+        # descriptions of the latest nodes, used to skip perceived events
+        self._recent = RecentMemory(retention)
+        self.cleanup_index()
+        for node_type in self.memory:
+            self._reset_recent(node_type)
         self.max_memory = max_memory
         self.max_importance = max_importance
         self._retrieve_config = {
@@ -147,6 +236,15 @@ class Associate:
             "relevance_weight": relevance_weight,
             "importance_weight": importance_weight,
         }
+        # merge near-duplicate nodes added within window minutes
+        self._consolidate = None
+        if consolidate:
+            self._consolidate = {
+                "node_types": ["event"],
+                "similarity": 0.9,
+                "window": 180,
+                **consolidate,
+            }
 
     def abstract(self):
         des = {"nodes": self._index.nodes_num}
@@ -158,11 +256,28 @@ class Associate:
         return utils.dump_dict(self.abstract())
 
     def cleanup_index(self):
-        node_ids = self._index.cleanup()
+        node_ids = set(self._index.cleanup())
+        if not node_ids:
+            return
         self.memory = {
             n_type: [n for n in nodes if n not in node_ids]
             for n_type, nodes in self.memory.items()
         }
+        self._forget(node_ids)
+        for node_type in self.memory:
+            if any(n in node_ids for n in self._recent.node_ids(node_type)):
+                self._reset_recent(node_type)
+
+    def _reset_recent(self, node_type):
+        node_ids = self.memory[node_type][: self.retention]
+        self._recent.reset(
+            node_type, [(n, self.find_concept(n).describe) for n in node_ids]
+        )
+
+    def is_recent(self, describe, node_types=("event", "chat")):
+        """Check if describe is one of the latest retention nodes of the node types"""
+
+        return self._recent.contains(describe, node_types)
 
     def add_node(
         self,
@@ -182,34 +297,106 @@ class Associate:
             "object": event.object,
             "address": ":".join(event.address),
             "poignancy": poignancy,
-            "create": create.strftime("%Y%m%d-%H:%M:%S"),
-            "expire": expire.strftime("%Y%m%d-%H:%M:%S"),
-            "access": create.strftime("%Y%m%d-%H:%M:%S"),
+            "create": create,
+            "expire": expire,
+            "access": create,
         }
         node = self._index.add_node(event.get_describe(), metadata)
         memory = self.memory[node_type]
         memory.insert(0, node.id_)
+        concept = self.to_concept(node)
+        self._recent.add(node_type, node.id_, concept.describe)
         if len(memory) >= self.max_memory > 0:
             self._index.remove_nodes(memory[self.max_memory:])
+            self._forget(memory[self.max_memory:])
             self.memory[node_type] = memory[: self.max_memory - 1]
-        return self.to_concept(node)
+            self._reset_recent(node_type)
+        return concept
+
+    def consolidate(self, node_type, event, create=None, expire=None):
+        """Merge event into a recent near-duplicate node
+
+        A node matches when subject, predicate and address are the same, and the
+        object is the same or the description is similar enough. Return the
+        concept of the merged node, or None when event should be a new node.
+        """
+
+        config = self._consolidate
+        if not config or node_type not in config["node_types"]:
+            return None
+        create = create or utils.get_timer().get_date()
+        expire = expire or (create + datetime.timedelta(days=30))
+        since = create - datetime.timedelta(minutes=config["window"])
+        describe = event.get_describe()
+        matched, candidates = None, []
+        # memory is ordered by the latest occurrence
+        for node_id in self.memory[node_type]:
+            concept = self.find_concept(node_id)
+            if concept.last < since:
+                break
+            c_event = concept.event
+            if (c_event.subject, c_event.predicate, c_event.address) != (
+                event.subject,
+                event.predicate,
+                event.address,
+            ):
+                continue
+            if c_event.object == event.object or concept.describe == describe:
+                matched = concept
+                break
+            candidates.append(node_id)
+        if not matched and candidates:
+            nodes = self._index.retrieve(
+                describe, similarity_top_k=1, node_ids=candidates
+            )
+            if nodes and nodes[0].score >= config["similarity"]:
+                matched = self.find_concept(nodes[0].id_)
+        if not matched:
+            return None
+        matched.count += 1
+        matched.last = max(matched.last, create)
+        matched.expire = max(matched.expire, expire)
+        self._index.update_metadata(
+            [matched.node_id],
+            {"count": matched.count, "last": matched.last, "expire": matched.expire},
+        )
+        memory = self.memory[node_type]
+        memory.remove(matched.node_id)
+        memory.insert(0, matched.node_id)
+        self._reset_recent(node_type)
+        return matched
+
+    def batch(self):
+        """Embed the nodes added in the context in one batch"""
+
+        return self._index.batch()
 
     def to_concept(self, node):
-        return Concept.from_node(node)
+        concept = self._concepts.get(node.id_)
+        if concept is None:
+            concept = Concept.from_node(node)
+            self._concepts[node.id_] = concept
+        return concept
 
     def find_concept(self, node_id):
-        return self.to_concept(self._index.find_node(node_id))
+        concept = self._concepts.get(node_id)
+        if concept is None:
+            concept = self.to_concept(self._index.find_node(node_id))
+        return concept
+
+    def _forget(self, node_ids):
+        for node_id in node_ids:
+            self._concepts.pop(node_id, None)
 
     def _retrieve_nodes(self, node_type, text=None):
-        if text:
-            filters = MetadataFilters(
-                filters=[ExactMatchFilter(key="node_type", value=node_type)]
-            )
-            nodes = self._index.retrieve(
-                text, filters=filters, node_ids=self.memory[node_type]
-            )
-        else:
-            nodes = [self._index.find_node(n) for n in self.memory[node_type]]
+        if not text:
+            return [self.find_concept(n) for n in self.memory[node_type][: self.retention]]
+        filters = MetadataFilters(
+            filters=[ExactMatchFilter(key="node_type", value=node_type)]
+        )
+        nodes = self._index.retrieve(
+            text, filters=filters, node_ids=self.memory[node_type]
+        )
         return [self.to_concept(n) for n in nodes[: self.retention]]
 
     def retrieve_events(self, text=None):
@@ -223,19 +410,14 @@ class Associate:
         return self._retrieve_nodes("chat", text)
 
     def retrieve_focus(self, focus, retrieve_max=30, reduce_all=True):
-        def _create_retriever(*args, **kwargs):
-            self._retrieve_config["retrieve_max"] = retrieve_max
-            return AssociateRetriever(self._retrieve_config, *args, **kwargs)
-
-        retrieved = {}
+        retrieved, focus = {}, list(focus)
         node_ids = self.memory["event"] + self.memory["thought"]
-        for text in focus:
-            nodes = self._index.retrieve(
-                text,
-                similarity_top_k=len(node_ids),
-                node_ids=node_ids,
-                retriever_creator=_create_retriever,
-            )
+        # all the focus are embedded and scored together
+        results = self._index.retrieve_many(
+            focus, similarity_top_k=len(node_ids), node_ids=node_ids
+        )
+        for text, nodes in zip(focus, results):
+            nodes = self._rerank(nodes, retrieve_max)
             if reduce_all:
                 retrieved.update({n.id_: n for n in nodes})
             else:
@@ -247,6 +429,39 @@ class Associate:
             for text, nodes, in retrieved.items()
         }
 
+    def _rerank(self, nodes, retrieve_max):
+        """Re-rank the retrieved nodes by recency, relevance and importance"""
+
+        if not nodes:
+            return []
+        access = [self._access_key(n) for n in nodes]
+        scores = [n.score for n in nodes]
+        poignancy = [n.metadata["poignancy"] for n in nodes]
+        order = rerank_scores(
+            access, scores, poignancy, self._retrieve_config, retrieve_max
+        )
+        nodes = [nodes[i] for i in order.tolist()]
+        now = utils.get_timer().get_date()
+        for n in nodes:
+            n.metadata["access"] = now
+        if not self._persist_access:
+            return nodes
+        # write through to the index and the cached concepts
+        self._index.update_metadata([n.id_ for n in nodes], {"access": now})
+        for n in nodes:
+            concept = self._concepts.get(n.id_)
+            if concept:
+                concept.access = now
+        return nodes
+
+    def _access_key(self, node):
+        # typed columns of NumpyIndex avoid converting the dates
+        columns = getattr(node, "columns", None)
+        if columns:
+            return int(columns["access"])
+        access = utils.to_date(node.metadata["access"])
+        return int((access - datetime.datetime(1970, 1, 1)).total_seconds())
+
     def get_relation(self, node):
         return {
             "node": node,
@@ -62,7 +62,7 @@ class LLMModel:
         self._summary.setdefault(caller, [0, 0, 0])
         for _ in range(retry):
             try:
-                meta_response = self._completion(prompt, **kwargs)
+                meta_response = self._play_completion(prompt, caller, **kwargs)
                 self._meta_responses.append(meta_response)
                 self._summary["total"][0] += 1
                 self._summary[caller][0] += 1
@@ -82,6 +82,18 @@ class LLMModel:
         self._summary[caller][pos] += 1
         return response or failsafe
 
+    def _play_completion(self, prompt, caller, **kwargs):
+        cassette = utils.get_cassette()
+        if not cassette:
+            return self._completion(prompt, **kwargs)
+        return cassette.completion(
+            lambda: self._completion(prompt, **kwargs),
+            self._model,
+            caller,
+            prompt,
+            **kwargs
+        )
+
     def _completion(self, prompt, **kwargs):
         raise NotImplementedError(
             "_completion is not support for " + str(self.__class__)
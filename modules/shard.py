@@ -0,0 +1,452 @@
+"""generative_agents.shard"""
+
+import os
+import copy
+import time
+import queue
+import threading
+import traceback
+import concurrent.futures
+import multiprocessing
+from multiprocessing.connection import wait
+
+from modules import memory, utils
+from .agent import Agent
+from .game import create_game
+from .maze import Maze
+
+
+class AgentRef:
+    """Reference to an agent that is passed between shards"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class RemoteLock:
+    """Lock of an agent owned by another shard"""
+
+    def __init__(self, agent):
+        self._agent = agent
+
+    def acquire(self, blocking=True, interval=0.05):
+        # the owner shard serves calls in one thread, so a blocking acquire
+        # polls instead of waiting in the owner
+        while not self._agent.call("acquire"):
+            if not blocking:
+                return False
+            time.sleep(interval)
+        # the state shipped at the start of the step may be changed by other
+        # reactions, query the owner once the agent is locked
+        self._agent.sync()
+        return True
+
+    def release(self):
+        self._agent.call("release")
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class RemoteAgent:
+    """Proxy of an agent that thinks in another process.
+
+    In the worker, the proxy holds the public state of a peer agent and
+    forwards calls (completion, schedule_chat, update_plan, lock) to the
+    owner shard, the state is queried again when the agent is locked.
+    In the coordinator, it records the latest state of the agent.
+    """
+
+    def __init__(self, state, maze, broker=None):
+        self.name = state["name"]
+        self.maze = maze
+        self._broker = broker
+        self.lock = RemoteLock(self) if broker else threading.RLock()
+        self._dict = {}
+        self.update(state)
+
+    def update(self, state, agent_dict=None):
+        state = copy.deepcopy(state)
+        self.coord, self.path = state["coord"], state["path"]
+        self.action = memory.Action.from_dict(state["action"])
+        self.schedule = memory.Schedule(**state["schedule"])
+        self.think_config = state["think_config"]
+        self._next_event = utils.to_date(state["next_event"])
+        if agent_dict is not None:
+            self._dict = agent_dict
+
+    def call(self, method, *args, **kwargs):
+        return self._broker.call(self.name, method, *args, **kwargs)
+
+    def completion(self, func_hint, *args, **kwargs):
+        return self.call("completion", func_hint, *args, **kwargs)
+
+    def schedule_chat(self, *args, **kwargs):
+        result = self.call("schedule_chat", *args, **kwargs)
+        self.sync()
+        return result
+
+    def update_plan(self, agents=None):
+        # the owner updates the plan with its own view of the agents
+        return self.call("update_plan")
+
+    def sync(self):
+        """Update the state from the owner shard"""
+
+        self.update(self.call("state"))
+
+    def get_tile(self):
+        return self.maze.tile_at(self.coord)
+
+    def get_event(self, as_act=True):
+        return self.action.event if as_act else self.action.obj_event
+
+    def next_event(self):
+        return self._next_event
+
+    def to_dict(self):
+        return self._dict
+
+
+def agent_state(agent):
+    """The public state of an agent shared with other shards"""
+
+    return {
+        "name": agent.name,
+        "coord": list(agent.coord),
+        "path": agent.path,
+        "action": agent.action.to_dict(),
+        "schedule": agent.schedule.to_dict(),
+        "think_config": agent.think_config,
+        "next_event": agent.next_event().strftime("%Y%m%d-%H:%M:%S"),
+    }
+
+
+class ShardBroker:
+    """Send calls to agents of other shards, and serve calls to local agents"""
+
+    def __init__(self, conn, game, logger):
+        self._conn = conn
+        self._game = game
+        self._logger = logger
+        self._send_lock = threading.Lock()
+        self._pending, self._req_id = {}, 0
+        # agents locked by calls from other shards
+        self._held = set()
+        self._requests = queue.Queue()
+        threading.Thread(target=self._listen, daemon=True).start()
+        # calls are served in one thread, so a remote lock is always
+        # acquired and released by the same thread
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def call(self, name, method, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._send_lock:
+            self._req_id += 1
+            req_id = self._req_id
+            self._pending[req_id] = future
+            self._conn.send(
+                ("request", req_id, (name, method, self._encode(args), self._encode(kwargs)))
+            )
+        status, result = future.result()
+        if status == "error":
+            raise RuntimeError("Remote call {}.{} failed:\n{}".format(name, method, result))
+        return result
+
+    def _send(self, msg):
+        with self._send_lock:
+            self._conn.send(msg)
+
+    def _listen(self):
+        while True:
+            try:
+                msg = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == "response":
+                self._pending.pop(msg[1]).set_result(msg[2])
+            else:
+                self._requests.put(msg)
+
+    def _serve(self):
+        while True:
+            _, req_id, (name, method, args, kwargs) = self._requests.get()
+            try:
+                result = ("ok", self._execute(name, method, args, kwargs))
+            except Exception:  # pylint: disable=broad-except
+                result = ("error", traceback.format_exc())
+            self._send(("response", req_id, result))
+
+    def _execute(self, name, method, args, kwargs):
+        agent = self._game.get_agent(name)
+        if method == "acquire":
+            if name in self._held or not agent.lock.acquire(blocking=False):
+                return False
+            self._held.add(name)
+            return True
+        if method == "release":
+            self._held.discard(name)
+            agent.lock.release()
+            return None
+        if method == "state":
+            return agent_state(agent)
+        if method == "update_plan":
+            return agent.update_plan(self._game.agents)
+        assert method in ("completion", "schedule_chat"), "Unexpected remote call " + method
+        self._logger.debug("{}.{} is called by another shard".format(name, method))
+        return getattr(agent, method)(*self._decode(args), **self._decode(kwargs))
+
+    def _encode(self, data):
+        def _encode_value(v):
+            if isinstance(v, (Agent, RemoteAgent)):
+                return AgentRef(v.name)
+            return v
+
+        if isinstance(data, dict):
+            return {k: _encode_value(v) for k, v in data.items()}
+        return [_encode_value(v) for v in data]
+
+    def _decode(self, data):
+        def _decode_value(v):
+            if isinstance(v, AgentRef):
+                return self._game.get_agent(v.name)
+            return v
+
+        if isinstance(data, dict):
+            return {k: _decode_value(v) for k, v in data.items()}
+        return [_decode_value(v) for v in data]
+
+
+def _run_shard(index, name, static_root, config, ctrl, rpc, log_path, verbose):
+    """Main loop of a shard process"""
+
+    if log_path:
+        logger = utils.create_file_logger(log_path, verbose)
+    else:
+        logger = utils.create_io_logger(verbose)
+    try:
+        game = create_game(name, static_root, config, utils.ConversationLog(), logger=logger)
+        game.reset_game(keys=config["api_keys"])
+        local = list(game.agents.keys())
+        broker = ShardBroker(rpc, game, logger)
+        workers = config.get("simulate", {}).get("workers", 1)
+        executor = None
+        if workers > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        ctrl.send(
+            (
+                "ready",
+                {
+                    "agents": {n: agent_state(game.agents[n]) for n in local},
+                    "tiles": game.maze.get_events(),
+                },
+            )
+        )
+        stamp, results = 0, {}
+        while True:
+            cmd, data = ctrl.recv()
+            if cmd == "stop":
+                break
+            if cmd == "think":
+                utils.set_timer(data["time"])
+                game.maze.set_events(data["tiles"])
+                for p_name, state in data["peers"].items():
+                    if p_name in game.agents:
+                        game.agents[p_name].update(state)
+                    else:
+                        # peers join game.agents so that local agents can see them
+                        game.agents[p_name] = RemoteAgent(state, game.maze, broker)
+                stamp = game.maze.get_stamp()
+                game.conversation.clear()
+                # reactions to other agents are deferred until all shards finished thinking
+                if executor:
+                    futures = {
+                        n: executor.submit(game.agent_think, n, s, True)
+                        for n, s in data["status"].items()
+                    }
+                    results = {n: f.result() for n, f in futures.items()}
+                else:
+                    results = {
+                        n: game.agent_think(n, s, True) for n, s in data["status"].items()
+                    }
+                ctrl.send(("done", None))
+            elif cmd == "react":
+                results = game.react(results, executor)
+                ctrl.send(("reacted", None))
+            elif cmd == "collect":
+                agents = {}
+                for n, res in results.items():
+                    agent = game.get_agent(n)
+                    # the plan may be updated by a reaction of another shard
+                    agents[n] = {
+                        "plan": agent.plan,
+                        "skipped": res["info"]["skipped"],
+                        "state": agent_state(agent),
+                        "dict": agent.to_dict(),
+                    }
+                ctrl.send(
+                    (
+                        "collected",
+                        {
+                            "agents": agents,
+                            "tiles": game.maze.get_events(since=stamp),
+                            "conversation": dict(game.conversation),
+                        },
+                    )
+                )
+        if executor:
+            executor.shutdown()
+    except Exception:  # pylint: disable=broad-except
+        ctrl.send(("error", "Shard[{}] failed:\n{}".format(index, traceback.format_exc())))
+
+
+class ShardGame:
+    """Coordinator of a game whose agents are sharded across processes.
+
+    The coordinator owns the maze events. Every step it sends the changed
+    tiles and the states of peer agents to each shard, lets all shards think,
+    then merges the tiles changed by each shard back. Calls from an agent
+    to an agent of another shard are routed through the coordinator.
+    """
+
+    def __init__(
+        self,
+        name,
+        static_root,
+        config,
+        conversation,
+        shards,
+        logger=None,
+        log_path=None,
+        verbose="info",
+    ):
+        utils.set_timer(**config.get("time", {}))
+        self.logger = logger or utils.IOLogger()
+        self.maze = Maze(
+            utils.load_dict(os.path.join(static_root, config["maze"]["path"])),
+            self.logger,
+        )
+        self.conversation = conversation
+        self.agents, self.owners = {}, {}
+
+        names = list(config["agents"].keys())
+        shards = min(shards, len(names))
+        context = multiprocessing.get_context("spawn")
+        self._shards = []
+        for idx in range(shards):
+            s_config = copy.deepcopy(config)
+            s_config["agents"] = {
+                n: config["agents"][n] for n in names[idx::shards]
+            }
+            ctrl, s_ctrl = context.Pipe()
+            rpc, s_rpc = context.Pipe()
+            s_log = "{}.shard{}".format(log_path, idx) if log_path else None
+            process = context.Process(
+                target=_run_shard,
+                args=(idx, name, static_root, s_config, s_ctrl, s_rpc, s_log, verbose),
+                daemon=True,
+            )
+            process.start()
+            self._shards.append(
+                {"process": process, "ctrl": ctrl, "rpc": rpc, "agents": list(s_config["agents"])}
+            )
+            for n in s_config["agents"]:
+                self.owners[n] = idx
+
+        for idx, shard in enumerate(self._shards):
+            data = self._receive(shard, "ready")
+            for n, state in data["agents"].items():
+                self.agents[n] = RemoteAgent(state, self.maze)
+            self._merge_tiles(shard, data["tiles"])
+            self.logger.info(
+                "Shard[{}] is ready with {} agents".format(idx, len(shard["agents"]))
+            )
+        self._stamp = 0
+        threading.Thread(target=self._route, daemon=True).start()
+
+    def get_agent(self, name):
+        return self.agents[name]
+
+    def think(self, agent_status):
+        tiles = self.maze.get_events(since=self._stamp)
+        states = {n: agent_state(a) for n, a in self.agents.items()}
+        for shard in self._shards:
+            data = {
+                "time": utils.get_timer().get_date("%Y%m%d-%H:%M"),
+                "status": {n: agent_status[n] for n in shard["agents"]},
+                "peers": {n: s for n, s in states.items() if n not in shard["agents"]},
+                "tiles": tiles,
+            }
+            shard["ctrl"].send(("think", data))
+        # react only after all shards finished thinking, and collect only after
+        # all shards finished reacting, so no remote call can change an agent
+        # after it has been collected
+        for shard in self._shards:
+            self._receive(shard, "done")
+        for shard in self._shards:
+            shard["ctrl"].send(("react", None))
+        for shard in self._shards:
+            self._receive(shard, "reacted")
+        self._stamp = self.maze.get_stamp()
+        results = {}
+        for shard in self._shards:
+            shard["ctrl"].send(("collect", None))
+            data = self._receive(shard, "collected")
+            self._merge_tiles(shard, data["tiles"])
+            for key, chats in data["conversation"].items():
+                for chat in chats:
+                    self.conversation.append(key, chat)
+            for n, res in data["agents"].items():
+                self.agents[n].update(res["state"], res["dict"])
+                results[n] = {"plan": res["plan"], "info": {"skipped": res["skipped"]}}
+        return results
+
+    def close(self):
+        for shard in self._shards:
+            shard["ctrl"].send(("stop", None))
+        for shard in self._shards:
+            shard["process"].join()
+
+    def _receive(self, shard, expect):
+        cmd, data = shard["ctrl"].recv()
+        if cmd == "error":
+            raise RuntimeError(data)
+        assert cmd == expect, "Expect {} from shard, get {}".format(expect, cmd)
+        return data
+
+    def _merge_tiles(self, shard, tile_events):
+        """Take events of agents owned by the shard and objects it touched"""
+
+        owned = set(shard["agents"])
+
+        def _owned(event):
+            return event.subject in owned or event.subject not in self.owners
+
+        with self.maze.lock:
+            for coord, events in tile_events.items():
+                tile = self.maze.tile_at(coord)
+                subjects = set(e.subject for e in events if _owned(e))
+                kept = [e for e in tile.get_events() if e.subject not in owned and e.subject not in subjects]
+                tile.set_events(kept + [e for e in events if _owned(e)])
+
+    def _route(self):
+        """Route remote calls between shards"""
+
+        conns = {shard["rpc"]: idx for idx, shard in enumerate(self._shards)}
+        while conns:
+            for conn in wait(list(conns.keys())):
+                try:
+                    kind, req_id, payload = conn.recv()
+                except (EOFError, OSError):
+                    conns.pop(conn)
+                    continue
+                if kind == "request":
+                    owner = self._shards[self.owners[payload[0]]]
+                    owner["rpc"].send(("request", (conns[conn], req_id), payload))
+                else:
+                    src, src_id = req_id
+                    self._shards[src]["rpc"].send(("response", src_id, payload))
@@ -0,0 +1,60 @@
+"""generative_agents.storage.expiry"""
+
+import heapq
+
+
+class ExpiryIndex:
+    """Min-heap of the expire time of nodes, so cleanup only visits expired nodes
+
+    Times can be any ordered values, e.g. epoch seconds or "%Y%m%d-%H:%M:%S"
+    strings. Removed nodes are dropped lazily when they reach the top of the
+    heap, the heap is rebuilt when most of its entries are stale. Nodes created
+    after the cleanup time are also expired, they only exist when the timer goes
+    backwards, so they are found by scanning when the latest create is ahead.
+    """
+
+    def __init__(self, entries=None):
+        self._entries = {}
+        self._heap = []
+        self._latest = None
+        for node_id, create, expire in entries or []:
+            self._entries[node_id] = (create, expire)
+        self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [(e, node_id) for node_id, (_, e) in self._entries.items()]
+        heapq.heapify(self._heap)
+        creates = [c for c, _ in self._entries.values()]
+        self._latest = max(creates) if creates else None
+
+    def add(self, node_id, create, expire):
+        self._entries[node_id] = (create, expire)
+        heapq.heappush(self._heap, (expire, node_id))
+        if self._latest is None or create > self._latest:
+            self._latest = create
+
+    def discard(self, node_id):
+        self._entries.pop(node_id, None)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._rebuild()
+
+    def pop_expired(self, now):
+        """Remove and return the ids of nodes with expire < now or create > now"""
+
+        expired = []
+        while self._heap and self._heap[0][0] < now:
+            expire, node_id = heapq.heappop(self._heap)
+            entry = self._entries.get(node_id)
+            if entry and entry[1] == expire:
+                del self._entries[node_id]
+                expired.append(node_id)
+        if self._latest is not None and self._latest > now:
+            future = [n for n, (c, _) in self._entries.items() if c > now]
+            for node_id in future:
+                del self._entries[node_id]
+            expired.extend(future)
+            self._rebuild()
+        return expired
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,45 +1,205 @@
 """generative_agents.storage.index"""
 
 import os
+import json
 import time
+import datetime
+import threading
+import contextlib
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
-from llama_index.core.schema import TextNode
+from llama_index.core.schema import TextNode, QueryBundle
 from llama_index import core as index_core
 from llama_index.embeddings.ollama import OllamaEmbedding
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core import Settings
+from llama_index.core.storage.storage_context import DOC_STORE_KEY, INDEX_STORE_KEY
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
 from modules import utils
+from .expiry import ExpiryIndex
+
+
+DATE_FORMAT = "%Y%m%d-%H:%M:%S"
+
+_embed_models = {}
+_embed_lock = threading.RLock()
+
+
+def get_embed_model(embedding, cassette=None, cache=None):
+    """Get the embedding model shared by all indexes with the same config"""
+
+    key = (
+        json.dumps(embedding, sort_keys=True),
+        id(cassette) if cassette else None,
+        id(cache) if cache else None,
+    )
+    with _embed_lock:
+        if key not in _embed_models:
+            if cache:
+                _embed_models[key] = CachedEmbedding(
+                    embedding, get_embed_model(embedding, cassette), cache
+                )
+            elif cassette:
+                _embed_models[key] = CassetteEmbedding(embedding, cassette)
+            else:
+                _embed_models[key] = create_embed_model(embedding)
+        return _embed_models[key]
+
+
+def get_query_embeddings(embed_model, queries):
+    """Embed the queries in one batch when the model supports it"""
+
+    if not queries:
+        return []
+    if isinstance(embed_model, CachedEmbedding):
+        return embed_model.get_query_embedding_batch(queries)
+    if isinstance(embed_model, OllamaEmbedding):
+        return embed_model.get_general_text_embeddings(
+            [embed_model._format_query(q) for q in queries]
+        )
+    return [embed_model.get_query_embedding(q) for q in queries]
+
+
+def create_embed_model(embedding):
+    if embedding["type"] == "hugging_face":
+        return HuggingFaceEmbedding(model_name=embedding["model"])
+    if embedding["type"] == "ollama":
+        return OllamaEmbedding(
+            model_name=embedding["model"],
+            base_url=embedding["base_url"],
+            ollama_additional_kwargs={"mirostat": 0},
+        )
+    raise NotImplementedError(
+        "embedding type {} is not supported".format(embedding["type"])
+    )
+
+
+class CassetteEmbedding(BaseEmbedding):
+    """Embedding model that plays embeddings through the cassette
+
+    The live model is only created when an embedding is missing from the cassette.
+    """
+
+    _embedding = PrivateAttr()
+    _embed_model = PrivateAttr(default=None)
+    _cassette = PrivateAttr()
+
+    def __init__(self, embedding, cassette, **kwargs):
+        super().__init__(model_name=embedding["model"], **kwargs)
+        self._embedding = embedding
+        self._cassette = cassette
+
+    def _get_embed_model(self):
+        if self._embed_model is None:
+            self._embed_model = get_embed_model(self._embedding)
+        return self._embed_model
+
+    def _play(self, kind, text):
+        def _call():
+            embed_model = self._get_embed_model()
+            if kind == "query":
+                return embed_model.get_query_embedding(text)
+            return embed_model.get_text_embedding(text)
+
+        model = "{}/{}".format(self.model_name, kind)
+        return self._cassette.embedding(_call, model, text)
+
+    def _get_query_embedding(self, query):
+        return self._play("query", query)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._play("text", text)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model that looks up the embedding cache before the wrapped model"""
+
+    _embed_model = PrivateAttr()
+    _cache = PrivateAttr()
+    _model = PrivateAttr()
+
+    def __init__(self, embedding, embed_model, cache, **kwargs):
+        kwargs.setdefault("embed_batch_size", embed_model.embed_batch_size)
+        super().__init__(model_name=embedding["model"], **kwargs)
+        self._embed_model = embed_model
+        self._cache = cache
+        self._model = "{}/{}".format(embedding["type"], embedding["model"])
+
+    def _cached(self, kind, texts, call):
+        keys = [self._cache.make_key(self._model, kind, t) for t in texts]
+        embeddings = [self._cache.get(k) for k in keys]
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        if missing:
+            results = call([texts[i] for i in missing])
+            for i, result in zip(missing, results):
+                embeddings[i] = self._cache.put(keys[i], result)
+        return embeddings
+
+    def _get_query_embedding(self, query):
+        return self._cached(
+            "query", [query], lambda t: [self._embed_model.get_query_embedding(t[0])]
+        )[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def get_query_embedding_batch(self, queries):
+        return self._cached(
+            "query", queries, lambda t: get_query_embeddings(self._embed_model, t)
+        )
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._cached("text", texts, self._embed_model.get_text_embedding_batch)
 
 
 class LlamaIndex:
-    def __init__(self, embedding, path=None):
-        self._config = {"max_nodes": 0}
-        if embedding["type"] == "hugging_face":
-            embed_model = HuggingFaceEmbedding(model_name=embedding["model"])
-        elif embedding["type"] == "ollama":
-            embed_model = OllamaEmbedding(
-                model_name=embedding["model"],
-                base_url=embedding["base_url"],
-                ollama_additional_kwargs={"mirostat": 0},
-            )
-        else:
-            raise NotImplementedError(
-                "embedding type {} is not supported".format(embedding["type"])
-            )
+    SEGMENTS = "segments.jsonl"
 
+    def __init__(self, embedding, path=None, compact_segments=50, state=None):
+        self._config = {"max_nodes": 0}
+        # changes since the last save, saved as a segment until compact_segments is reached
+        self._added, self._removed = [], []
+        # metadata updated since the last save, by node id
+        self._updated = {}
+        self._segments, self._compact_segments = 0, compact_segments
+        # nodes added in batch mode, embedded together when flushed
+        self._pending, self._batch_depth = [], 0
+        # expire times of the nodes, built on the first cleanup
+        self._expiry = None
+        embed_model = get_embed_model(
+            embedding, utils.get_cassette(), utils.get_embed_cache()
+        )
         Settings.embed_model = embed_model
         Settings.node_parser = SentenceSplitter(chunk_size=512, chunk_overlap=64)
         Settings.num_output = 1024
         Settings.context_window = 4096
-        if path and os.path.exists(path):
+        if state:
+            # restore from get_state(), which matches the saved files in path
+            self._index = index_core.load_index_from_storage(
+                index_core.StorageContext.from_dict(state["storage"]),
+                embed_model=embed_model,
+            )
+            self._config = state["config"]
+            self._segments = state["segments"]
+        elif path and os.path.exists(path):
             self._index = index_core.load_index_from_storage(
                 index_core.StorageContext.from_defaults(persist_dir=path),
                 show_progress=True,
+                embed_model=embed_model,
             )
             self._config = utils.load_dict(os.path.join(path, "index_config.json"))
+            self._load_segments(path)
         else:
-            self._index = index_core.VectorStoreIndex([], show_progress=True)
+            self._index = index_core.VectorStoreIndex(
+                [], show_progress=True, embed_model=embed_model
+            )
         self._path = path
 
     def add_node(
@@ -50,31 +210,76 @@ class LlamaIndex:
         exclude_embedding_keys=None,
         id=None,
     ):
-        while True:
+        # typed dates are stored as strings in the docstore
+        metadata = {
+            k: v.strftime(DATE_FORMAT) if isinstance(v, datetime.datetime) else v
+            for k, v in (metadata or {}).items()
+        }
+        exclude_llm_keys = exclude_llm_keys or list(metadata.keys())
+        exclude_embedding_keys = exclude_embedding_keys or list(metadata.keys())
+        id = id or "node_" + str(self._config["max_nodes"])
+        self._config["max_nodes"] += 1
+        node = TextNode(
+            text=text,
+            id_=id,
+            metadata=metadata,
+            excluded_llm_metadata_keys=exclude_llm_keys,
+            excluded_embed_metadata_keys=exclude_embedding_keys,
+        )
+        self._pending.append(node)
+        if not self._batch_depth:
+            self.flush()
+        return node
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue the added nodes and embed them in one batch
+
+        Queued nodes can be found at once, they are flushed before any retrieval,
+        removal or save, and when the outermost batch exits.
+        """
+
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self):
+        """Embed and insert the queued nodes"""
+
+        while self._pending:
             try:
-                metadata = metadata or {}
-                exclude_llm_keys = exclude_llm_keys or list(metadata.keys())
-                exclude_embedding_keys = exclude_embedding_keys or list(metadata.keys())
-                id = id or "node_" + str(self._config["max_nodes"])
-                self._config["max_nodes"] += 1
-                node = TextNode(
-                    text=text,
-                    id_=id,
-                    metadata=metadata,
-                    excluded_llm_metadata_keys=exclude_llm_keys,
-                    excluded_embed_metadata_keys=exclude_embedding_keys,
-                )
-                self._index.insert_nodes([node])
-                return node
+                self._index.insert_nodes(self._pending)
+                self._added.extend(n.id_ for n in self._pending)
+                if self._expiry is not None:
+                    for n in self._pending:
+                        self._expiry.add(n.id_, n.metadata["create"], n.metadata["expire"])
+                self._pending = []
             except Exception as e:
-                print(f"LlamaIndex.add_node() caused an error: {e}")
+                print(f"LlamaIndex.flush() caused an error: {e}")
                 time.sleep(5)
 
+    def _find_pending(self, node_id):
+        for node in self._pending:
+            if node.id_ == node_id:
+                return node
+        return None
+
     def has_node(self, node_id):
-        return node_id in self._index.docstore.docs
+        if node_id in self._index.docstore.docs:
+            return True
+        return self._find_pending(node_id) is not None
 
     def find_node(self, node_id):
-        return self._index.docstore.docs[node_id]
+        if node_id in self._index.docstore.docs:
+            return self._index.docstore.docs[node_id]
+        node = self._find_pending(node_id)
+        if node is None:
+            raise KeyError(node_id)
+        return node
 
     def get_nodes(self, filter=None):
         def _check(node):
@@ -82,19 +287,51 @@ class LlamaIndex:
                 return True
             return filter(node)
 
-        return [n for n in self._index.docstore.docs.values() if _check(n)]
+        nodes = list(self._index.docstore.docs.values()) + self._pending
+        return [n for n in nodes if _check(n)]
 
     def remove_nodes(self, node_ids, delete_from_docstore=True):
+        self.flush()
         self._index.delete_nodes(node_ids, delete_from_docstore=delete_from_docstore)
+        for node_id in node_ids:
+            if self._expiry is not None:
+                self._expiry.discard(node_id)
+            self._updated.pop(node_id, None)
+            if node_id in self._added:
+                self._added.remove(node_id)
+            else:
+                self._removed.append(node_id)
+
+    def update_metadata(self, node_ids, metadata):
+        """Update the metadata of the nodes with the same values"""
+
+        metadata = {
+            k: v.strftime(DATE_FORMAT) if isinstance(v, datetime.datetime) else v
+            for k, v in metadata.items()
+        }
+        updated = {}
+        for node_id in node_ids:
+            node = self._find_pending(node_id)
+            if node:
+                node.metadata.update(metadata)
+                continue
+            updated[node_id] = metadata
+            if node_id not in self._added:
+                self._updated.setdefault(node_id, {}).update(metadata)
+        self._apply_updates(updated)
 
     def cleanup(self):
-        now, remove_ids = utils.get_timer().get_date(), []
-        for node_id, node in self._index.docstore.docs.items():
-            create = utils.to_date(node.metadata["create"])
-            expire = utils.to_date(node.metadata["expire"])
-            if create > now or expire < now:
-                remove_ids.append(node_id)
-        self.remove_nodes(remove_ids)
+        self.flush()
+        if self._expiry is None:
+            # dates in DATE_FORMAT are ordered as strings, no parsing needed
+            self._expiry = ExpiryIndex(
+                (node_id, node.metadata["create"], node.metadata["expire"])
+                for node_id, node in self._index.docstore.docs.items()
+            )
+        now = utils.get_timer().get_date(DATE_FORMAT)
+        remove_ids = self._expiry.pop_expired(now)
+        if remove_ids:
+            self.remove_nodes(remove_ids)
         return remove_ids
 
     def retrieve(
@@ -105,6 +342,7 @@ class LlamaIndex:
         node_ids=None,
         retriever_creator=None,
     ):
+        self.flush()
         while True:
             try:
                 retriever_creator = retriever_creator or VectorIndexRetriever
@@ -118,6 +356,33 @@ class LlamaIndex:
                 print(f"LlamaIndex.retrieve() caused an error: {e}")
                 time.sleep(5)
 
+    def retrieve_many(self, texts, similarity_top_k=5, filters=None, node_ids=None):
+        """Retrieve nodes for each of texts, the queries are embedded in one batch"""
+
+        self.flush()
+        while True:
+            try:
+                embeddings = get_query_embeddings(self._index._embed_model, texts)
+                break
+            except Exception as e:
+                print(f"LlamaIndex.retrieve_many() caused an error: {e}")
+                time.sleep(5)
+        while True:
+            try:
+                retriever = VectorIndexRetriever(
+                    self._index,
+                    similarity_top_k=similarity_top_k,
+                    filters=filters,
+                    node_ids=node_ids,
+                )
+                return [
+                    retriever.retrieve(QueryBundle(query_str=text, embedding=embedding))
+                    for text, embedding in zip(texts, embeddings)
+                ]
+            except Exception as e:
+                print(f"LlamaIndex.retrieve_many() caused an error: {e}")
+                time.sleep(5)
+
     def query(
         self,
         text,
@@ -133,6 +398,7 @@ class LlamaIndex:
             "refine_template": refine_template,
             "filters": filters,
         }
+        self.flush()
         while True:
             try:
                 if query_creator:
@@ -145,10 +411,122 @@ class LlamaIndex:
                 time.sleep(5)
 
     def save(self, path=None):
+        """Save the index, only the changes are appended as a segment if possible"""
+
+        self.flush()
         path = path or self._path
-        self._index.storage_context.persist(path)
-        utils.save_dict(self._config, os.path.join(path, "index_config.json"))
+        compact = (
+            path != self._path
+            or not os.path.exists(os.path.join(path, "index_config.json"))
+            or self._segments >= self._compact_segments
+        )
+        if not compact and not self._added and not self._removed and not self._updated:
+            return
+        writer = utils.get_writer()
+        if compact:
+            if writer:
+                writer.submit(self._persist, self._snapshot(), dict(self._config), path)
+            else:
+                self._write(self._index.storage_context, self._config, path)
+            if path == self._path:
+                self._segments = 0
+        else:
+            segment = self._segment()
+            if writer:
+                writer.submit(self._append_segment, segment, path)
+            else:
+                self._append_segment(segment, path)
+            self._segments += 1
+        if path == self._path:
+            self._added, self._removed, self._updated = [], [], {}
+
+    def _snapshot(self):
+        data = self._index.storage_context.to_dict()
+        # stores keep one dict per collection, entries are replaced but not modified
+        for key in [DOC_STORE_KEY, INDEX_STORE_KEY]:
+            data[key] = {c: dict(v) for c, v in data[key].items()}
+        return data
+
+    def get_state(self):
+        """State of the saved index, used to restore without loading the files"""
+
+        self.flush()
+        return {
+            "storage": self._snapshot(),
+            "config": dict(self._config),
+            "segments": self._segments,
+        }
+
+    def _segment(self):
+        vector_store = self._index.vector_store
+        added = []
+        for node_id in self._added:
+            added.append(
+                {
+                    "node": self.find_node(node_id).to_dict(),
+                    "embedding": list(vector_store.get(node_id)),
+                }
+            )
+        return {
+            "add": added,
+            "remove": list(self._removed),
+            "update": {k: dict(v) for k, v in self._updated.items()},
+            "config": dict(self._config),
+        }
+
+    @classmethod
+    def _persist(cls, data, config, path):
+        cls._write(index_core.StorageContext.from_dict(data), config, path)
+
+    @classmethod
+    def _write(cls, storage_context, config, path):
+        storage_context.persist(path)
+        utils.save_dict(config, os.path.join(path, "index_config.json"))
+        segments = os.path.join(path, cls.SEGMENTS)
+        if os.path.exists(segments):
+            os.remove(segments)
+
+    @classmethod
+    def _append_segment(cls, segment, path):
+        with open(os.path.join(path, cls.SEGMENTS), "a", encoding="utf-8") as f:
+            f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+
+    def _load_segments(self, path):
+        segments = os.path.join(path, self.SEGMENTS)
+        if not os.path.exists(segments):
+            return
+        with open(segments, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                segment = json.loads(line)
+                nodes = []
+                for added in segment["add"]:
+                    node = TextNode.from_dict(added["node"])
+                    node.embedding = added["embedding"]
+                    nodes.append(node)
+                if nodes:
+                    self._index.insert_nodes(nodes)
+                removed = [n for n in segment["remove"] if self.has_node(n)]
+                if removed:
+                    self._index.delete_nodes(removed, delete_from_docstore=True)
+                self._apply_updates(segment.get("update", {}))
+                self._config = segment["config"]
+                self._segments += 1
+
+    def _apply_updates(self, updated):
+        docstore, nodes = self._index.docstore, []
+        for node_id, metadata in updated.items():
+            node = docstore.get_document(node_id, raise_error=False)
+            if node is None:
+                continue
+            node.metadata.update(metadata)
+            nodes.append(node)
+            if "expire" in metadata and self._expiry is not None:
+                self._expiry.add(node_id, node.metadata["create"], node.metadata["expire"])
+        if nodes:
+            docstore.add_documents(nodes, allow_update=True)
 
     @property
     def nodes_num(self):
-        return len(self._index.docstore.docs)
+        return len(self._index.docstore.docs) + len(self._pending)
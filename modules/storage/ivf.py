@@ -0,0 +1,129 @@
+"""generative_agents.storage.ivf"""
+
+import numpy as np
+
+
+def nearest(vectors, centroids, chunk=65536):
+    """Index of the most similar centroid of each vector"""
+
+    assign = np.zeros(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        scores = vectors[start : start + chunk] @ centroids.T
+        assign[start : start + chunk] = np.argmax(scores, axis=1)
+    return assign
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def kmeans(vectors, nlist, iterations=10, seed=0):
+    """Spherical k-means of normalized vectors, return the normalized centroids"""
+
+    rng = np.random.default_rng(seed)
+    nlist = min(nlist, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        lists, starts = np.unique(assign[order], return_index=True)
+        sums = np.add.reduceat(vectors[order], starts, axis=0)
+        centroids[lists] = normalize(sums)
+        # empty lists are moved to random vectors
+        empty = np.setdiff1d(np.arange(nlist), lists)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty))]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file index of the rows of a normalized vector matrix
+
+    Rows are assigned to the nearest of nlist k-means centroids, a query only
+    scores the rows of its nprobe nearest lists, so nprobe trades recall for
+    latency. The vectors stay in the owner's matrix, only the list of each row
+    is kept and updated as rows are added, or removed by moving the last row.
+    The centroids are trained when the matrix reaches min_nodes rows, and
+    trained again when it grows by retrain_factor since the last training.
+    """
+
+    def __init__(
+        self,
+        nlist=0,
+        nprobe=16,
+        min_nodes=10000,
+        retrain_factor=4,
+        sample=64,
+        iterations=10,
+        seed=0,
+    ):
+        # nlist of 0 uses sqrt of the number of rows
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_nodes = min_nodes
+        self.retrain_factor = retrain_factor
+        self.sample = sample
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._size, self._trained_size = 0, 0
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def needs_train(self, size):
+        if size < self.min_nodes:
+            return False
+        return not self.trained or size > self._trained_size * self.retrain_factor
+
+    def train(self, vectors):
+        """Train the centroids on a sample of vectors and assign all the rows"""
+
+        size = len(vectors)
+        nlist = self.nlist or max(int(np.sqrt(size)), 1)
+        rng = np.random.default_rng(self.seed)
+        sample = min(size, nlist * self.sample)
+        rows = np.sort(rng.choice(size, sample, replace=False))
+        self.centroids = kmeans(vectors[rows], nlist, self.iterations, self.seed)
+        self._assign = nearest(vectors, self.centroids)
+        self._size, self._trained_size = size, size
+
+    def add(self, start, vectors):
+        """Assign the rows from start, which are appended to the matrix"""
+
+        if not self.trained:
+            return
+        end = start + len(vectors)
+        if end > len(self._assign):
+            grown = np.zeros(max(end, 2 * len(self._assign)), dtype=np.int32)
+            grown[: self._size] = self._assign[: self._size]
+            self._assign = grown
+        self._assign[start:end] = nearest(vectors, self.centroids)
+        self._size = end
+
+    def remove(self, row):
+        """Remove a row by moving the last row into it"""
+
+        if not self.trained:
+            return
+        self._size -= 1
+        self._assign[row] = self._assign[self._size]
+
+    def probe(self, queries, nprobe=None):
+        """Mask of the probed lists of each query, shaped (queries, nlist)"""
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        scores = queries @ self.centroids.T
+        lists = np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+        probed = np.zeros(scores.shape, dtype=bool)
+        np.put_along_axis(probed, lists, True, axis=1)
+        return probed
+
+    def lists(self, rows):
+        return self._assign[: self._size][rows]
+
+    def __len__(self):
+        return self._size
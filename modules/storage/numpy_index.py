@@ -0,0 +1,743 @@
+"""generative_agents.storage.numpy_index"""
+
+import os
+import json
+import time
+import datetime
+import contextlib
+import numpy as np
+from llama_index.core.vector_stores import FilterCondition, FilterOperator
+
+from modules import utils
+from .index import get_embed_model, get_query_embeddings, DATE_FORMAT
+from .expiry import ExpiryIndex
+from .ivf import IVFIndex
+from .vectors import MappedVectors
+from .quantize import QuantizedVectors
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# typed metadata columns, dates are held as epoch seconds
+COLUMNS = {
+    "create": np.int64,
+    "expire": np.int64,
+    "access": np.int64,
+    "poignancy": np.int32,
+}
+DATE_COLUMNS = ("create", "expire", "access")
+
+
+def to_seconds(date):
+    return int((utils.to_date(date) - EPOCH).total_seconds())
+
+
+def to_datetime(seconds):
+    return EPOCH + datetime.timedelta(seconds=int(seconds))
+
+
+def to_metadata(info, columns):
+    """Metadata of LlamaIndex, with the dates of the columns as strings"""
+
+    metadata = dict(info)
+    for key, value in columns.items():
+        if key in DATE_COLUMNS:
+            metadata[key] = to_datetime(value).strftime(DATE_FORMAT)
+        else:
+            metadata[key] = int(value)
+    return metadata
+
+
+class VectorNode:
+    """Node returned by NumpyIndex, compatible with the nodes of LlamaIndex
+
+    The metadata holds typed values, dates are datetime and poignancy is int.
+    """
+
+    __slots__ = ("id_", "text", "info", "columns", "score", "_metadata")
+
+    def __init__(self, id_, text, info, columns, score=None):
+        self.id_ = id_
+        self.text = text
+        self.info = info
+        self.columns = columns
+        self.score = score
+        self._metadata = None
+
+    @classmethod
+    def from_metadata(cls, id_, text, metadata):
+        info = {k: v for k, v in metadata.items() if k not in COLUMNS}
+        columns = {
+            k: to_seconds(metadata[k]) if k in DATE_COLUMNS else int(metadata[k])
+            for k in COLUMNS
+        }
+        return cls(id_, text, info, columns)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = dict(self.info)
+            for key, value in self.columns.items():
+                value = to_datetime(value) if key in DATE_COLUMNS else int(value)
+                self._metadata[key] = value
+        return self._metadata
+
+    @property
+    def node_id(self):
+        return self.id_
+
+
+class Partition:
+    """Nodes of one node_type
+
+    The normalized embeddings are held as MappedVectors or QuantizedVectors and
+    the typed metadata as columns, both sharing the row of the node.
+    """
+
+    def __init__(self, ids=None, texts=None, infos=None, vectors=None, columns=None):
+        self.ids, self.texts, self.infos = ids or [], texts or [], infos or []
+        if vectors is None:
+            vectors = MappedVectors()
+        elif isinstance(vectors, np.ndarray):
+            vectors = MappedVectors.from_array(vectors)
+        self._vectors = vectors
+        columns = columns or {}
+        self._columns = {
+            k: np.asarray(columns.get(k, np.zeros(len(self.ids))), dtype=dtype)
+            for k, dtype in COLUMNS.items()
+        }
+
+    def append(self, nodes, vectors):
+        size = len(self.ids)
+        self._vectors.append(vectors)
+        capacity = len(next(iter(self._columns.values())))
+        if size + len(nodes) > capacity:
+            capacity = max(size + len(nodes), capacity * 2, 16)
+            for key, column in self._columns.items():
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:size] = column[:size]
+                self._columns[key] = grown
+        for key, column in self._columns.items():
+            column[size : size + len(nodes)] = [n.columns[key] for n in nodes]
+        self.ids.extend(n.id_ for n in nodes)
+        self.texts.extend(n.text for n in nodes)
+        self.infos.extend(n.info for n in nodes)
+
+    def remove(self, row):
+        """Remove a row by moving the last row into it, return the moved node id"""
+
+        last = len(self.ids) - 1
+        moved = None
+        self._vectors.remove(row)
+        if row != last:
+            for values in (self.ids, self.texts, self.infos):
+                values[row] = values[last]
+            for column in self._columns.values():
+                column[row] = column[last]
+            moved = self.ids[row]
+        for values in (self.ids, self.texts, self.infos):
+            values.pop()
+        return moved
+
+    def update(self, row, key, value):
+        self._columns[key][row] = value
+
+    def node(self, row, score=None):
+        columns = {k: c[row] for k, c in self._columns.items()}
+        return VectorNode(self.ids[row], self.texts[row], self.infos[row], columns, score)
+
+    def column(self, key):
+        return self._columns[key][: len(self.ids)]
+
+    def embedding(self, row):
+        """The float32 embedding of a row, exact when it is kept"""
+
+        vectors = getattr(self._vectors, "exact", None)
+        if vectors is None:
+            vectors = self._vectors
+        return np.asarray(vectors[[row]][0], dtype=np.float32)
+
+    @property
+    def vectors(self):
+        return self._vectors
+
+    @property
+    def columns(self):
+        return {k: self.column(k) for k in self._columns}
+
+
+class NumpyIndex:
+    """Vector index that keeps the embeddings in one float32 matrix per node_type
+
+    Embeddings are normalized when added, so the cosine similarity of a query is
+    a single matrix product and the top-k is selected with argpartition. Dates
+    and poignancy are typed columns. The index is saved as .npy matrices of the
+    vectors and the columns with a JSON of the nodes, changes since then are
+    appended as segments, until compact_segments is reached.
+
+    With the ann config, large partitions are searched with an IVFIndex, only the
+    nodes of the probed lists are scored and returned. With precision float16 or
+    int8, the embeddings are stored and scored in reduced precision, and rerank
+    keeps the float32 embeddings to re-score the top rerank * k nodes exactly.
+    """
+
+    NODES = "numpy_index.json"
+    SEGMENTS = "numpy_segments.jsonl"
+
+    def __init__(
+        self,
+        embedding,
+        path=None,
+        state=None,
+        ann=None,
+        precision="float32",
+        rerank=0,
+        compact_segments=50,
+        **kwargs,
+    ):
+        self._config = {"max_nodes": 0}
+        # changes since the last save, saved as a segment until compact_segments is reached
+        self._added, self._removed = [], []
+        # metadata updated since the last save, by node id
+        self._updated = {}
+        self._segments, self._compact_segments = 0, compact_segments
+        self._precision, self._rerank = precision, rerank
+        # approximate search of each partition, built when it is first needed
+        self._ann_config, self._ann = ann, {}
+        self._embed_model = get_embed_model(
+            embedding, utils.get_cassette(), utils.get_embed_cache()
+        )
+        self._partitions, self._rows = {}, {}
+        # nodes added in batch mode, embedded together when flushed
+        self._pending, self._batch_depth = [], 0
+        # expire times of the nodes, built on the first cleanup
+        self._expiry = None
+        if state:
+            self._restore(state)
+        elif path and os.path.exists(os.path.join(path, self.NODES)):
+            self._load(path)
+            self._load_segments(path)
+        self._path = path
+
+    def add_node(
+        self,
+        text,
+        metadata=None,
+        exclude_llm_keys=None,
+        exclude_embedding_keys=None,
+        id=None,
+    ):
+        id = id or "node_" + str(self._config["max_nodes"])
+        self._config["max_nodes"] += 1
+        node = VectorNode.from_metadata(id, text, metadata or {})
+        self._pending.append(node)
+        if not self._batch_depth:
+            self.flush()
+        return node
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue the added nodes and embed them in one batch"""
+
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self):
+        """Embed and insert the queued nodes"""
+
+        while self._pending:
+            try:
+                embeddings = self._embed_model.get_text_embedding_batch(
+                    [n.text for n in self._pending]
+                )
+                self._insert(self._pending, np.array(embeddings, dtype=np.float32))
+                self._added.extend(n.id_ for n in self._pending)
+                self._pending = []
+            except Exception as e:
+                print(f"NumpyIndex.flush() caused an error: {e}")
+                time.sleep(5)
+
+    def _insert(self, nodes, vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        groups = {}
+        for idx, node in enumerate(nodes):
+            groups.setdefault(node.info.get("node_type", ""), []).append(idx)
+        for node_type, idxs in groups.items():
+            if node_type not in self._partitions:
+                self._partitions[node_type] = Partition(vectors=self._create_vectors())
+            partition = self._partitions[node_type]
+            size = len(partition.ids)
+            partition.append([nodes[i] for i in idxs], vectors[idxs])
+            for row, i in enumerate(idxs):
+                self._rows[nodes[i].id_] = (node_type, size + row)
+            if node_type in self._ann:
+                self._ann[node_type].add(size, vectors[idxs])
+        if self._expiry is not None:
+            for node in nodes:
+                self._expiry.add(node.id_, node.columns["create"], node.columns["expire"])
+
+    def _find_pending(self, node_id):
+        for node in self._pending:
+            if node.id_ == node_id:
+                return node
+        return None
+
+    def has_node(self, node_id):
+        return node_id in self._rows or self._find_pending(node_id) is not None
+
+    def find_node(self, node_id):
+        if node_id in self._rows:
+            node_type, row = self._rows[node_id]
+            return self._partitions[node_type].node(row)
+        node = self._find_pending(node_id)
+        if node is None:
+            raise KeyError(node_id)
+        return node
+
+    def get_nodes(self, filter=None):
+        def _check(node):
+            if not filter:
+                return True
+            return filter(node)
+
+        nodes = [
+            p.node(row) for p in self._partitions.values() for row in range(len(p.ids))
+        ]
+        return [n for n in nodes + self._pending if _check(n)]
+
+    def remove_nodes(self, node_ids, delete_from_docstore=True):
+        self.flush()
+        for node_id in node_ids:
+            if node_id not in self._rows:
+                continue
+            node_type, row = self._rows.pop(node_id)
+            if self._expiry is not None:
+                self._expiry.discard(node_id)
+            moved = self._partitions[node_type].remove(row)
+            if node_type in self._ann:
+                self._ann[node_type].remove(row)
+            if moved:
+                self._rows[moved] = (node_type, row)
+            self._updated.pop(node_id, None)
+            if node_id in self._added:
+                self._added.remove(node_id)
+            else:
+                self._removed.append(node_id)
+
+    def update_metadata(self, node_ids, metadata):
+        """Update the metadata of the nodes with the same values"""
+
+        columns = {
+            k: to_seconds(v) if k in DATE_COLUMNS else int(v)
+            for k, v in metadata.items()
+            if k in COLUMNS
+        }
+        metadata = {
+            k: v.strftime(DATE_FORMAT) if isinstance(v, datetime.datetime) else v
+            for k, v in metadata.items()
+        }
+        info = {k: v for k, v in metadata.items() if k not in COLUMNS}
+        for node_id in node_ids:
+            if node_id in self._rows:
+                node_type, row = self._rows[node_id]
+                partition = self._partitions[node_type]
+                for key, value in columns.items():
+                    partition.update(row, key, value)
+                if info:
+                    partition.infos[row] = {**partition.infos[row], **info}
+                if "expire" in columns and self._expiry is not None:
+                    create = int(partition.column("create")[row])
+                    self._expiry.add(node_id, create, columns["expire"])
+                if node_id not in self._added:
+                    self._updated.setdefault(node_id, {}).update(metadata)
+                continue
+            node = self._find_pending(node_id)
+            if node is not None:
+                node.columns.update(columns)
+                node.info = {**node.info, **info}
+                node._metadata = None
+
+    def cleanup(self):
+        self.flush()
+        if self._expiry is None:
+            self._expiry = ExpiryIndex(
+                (node_id, create, expire)
+                for p in self._partitions.values()
+                for node_id, create, expire in zip(
+                    p.ids, p.column("create").tolist(), p.column("expire").tolist()
+                )
+            )
+        remove_ids = self._expiry.pop_expired(to_seconds(utils.get_timer().get_date()))
+        if remove_ids:
+            self.remove_nodes(remove_ids)
+        return remove_ids
+
+    def _create_vectors(self):
+        if self._precision == "float32":
+            return MappedVectors()
+        return QuantizedVectors.create(self._precision, exact=self._rerank > 0)
+
+    def _convert(self, vectors):
+        """Convert loaded vectors to the configured precision"""
+
+        precision = getattr(vectors, "precision", "float32")
+        exact = getattr(vectors, "exact", vectors)
+        if precision == self._precision:
+            if precision == "float32" or exact is not None or not self._rerank:
+                return vectors
+        converted = self._create_vectors()
+        if len(vectors):
+            data = (exact if exact is not None else vectors)[slice(None)]
+            converted.append(np.asarray(data, dtype=np.float32))
+        return converted
+
+    def _exact_scores(self, keys, query):
+        scores, groups = np.zeros(len(keys), dtype=np.float32), {}
+        for idx, (node_type, row) in enumerate(keys):
+            groups.setdefault(node_type, ([], []))
+            groups[node_type][0].append(idx)
+            groups[node_type][1].append(row)
+        for node_type, (idxs, rows) in groups.items():
+            vectors = self._partitions[node_type].vectors
+            scores[idxs] = vectors.exact_dot(np.array(rows), query[None])[:, 0]
+        return scores
+
+    def _get_ann(self, node_type):
+        if not self._ann_config:
+            return None
+        if node_type not in self._ann:
+            self._ann[node_type] = IVFIndex(**self._ann_config)
+        ann, partition = self._ann[node_type], self._partitions[node_type]
+        if ann.needs_train(len(partition.ids)):
+            ann.train(partition.vectors)
+        return ann if ann.trained else None
+
+    def _match_filters(self, node_type, rows, filters):
+        """Keep the rows of a partition matching every exact filter"""
+
+        if not filters:
+            return rows
+        if filters.condition not in (None, FilterCondition.AND):
+            raise NotImplementedError(
+                "filter condition {} is not supported".format(filters.condition)
+            )
+        partition = self._partitions[node_type]
+        for f in filters.filters:
+            if f.operator != FilterOperator.EQ:
+                raise NotImplementedError(
+                    "filter operator {} is not supported".format(f.operator)
+                )
+            if f.key == "node_type":
+                if f.value != node_type:
+                    return rows[:0]
+            elif f.key in COLUMNS:
+                value = to_seconds(f.value) if f.key in DATE_COLUMNS else int(f.value)
+                rows = rows[partition.column(f.key)[rows] == value]
+            else:
+                rows = rows[
+                    [partition.infos[r].get(f.key) == f.value for r in rows.tolist()]
+                ]
+        return rows
+
+    def retrieve(self, text, similarity_top_k=5, filters=None, node_ids=None):
+        return self.retrieve_many([text], similarity_top_k, filters, node_ids)[0]
+
+    def retrieve_many(self, texts, similarity_top_k=5, filters=None, node_ids=None):
+        """Retrieve nodes for each of texts
+
+        The queries are embedded in one batch and scored against the candidate
+        rows with one matrix product. Rows outside the probed lists of a query
+        are excluded when the partition is searched approximately.
+        """
+
+        self.flush()
+        candidates = {}
+        if node_ids is None:
+            for node_type, partition in self._partitions.items():
+                candidates[node_type] = np.arange(len(partition.ids))
+        else:
+            for node_id in node_ids:
+                if node_id in self._rows:
+                    node_type, row = self._rows[node_id]
+                    candidates.setdefault(node_type, []).append(row)
+        candidates = {
+            t: self._match_filters(t, np.asarray(rows, dtype=np.int64), filters)
+            for t, rows in candidates.items()
+        }
+        candidates = {t: rows for t, rows in candidates.items() if len(rows)}
+        if not candidates or similarity_top_k <= 0:
+            return [[] for _ in texts]
+        while True:
+            try:
+                queries = np.array(
+                    get_query_embeddings(self._embed_model, texts), dtype=np.float32
+                )
+                break
+            except Exception as e:
+                print(f"NumpyIndex.retrieve_many() caused an error: {e}")
+                time.sleep(5)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms > 0, norms, 1)
+        keys, scores, masks = [], [], []
+        for node_type, rows in candidates.items():
+            ann, mask = self._get_ann(node_type), None
+            if ann:
+                mask = ann.probe(queries)[:, ann.lists(rows)]
+                keep = mask.any(axis=0)
+                rows, mask = rows[keep], mask[:, keep]
+            scores.append(self._partitions[node_type].vectors.dot(rows, queries))
+            keys.extend((node_type, r) for r in rows.tolist())
+            masks.append(mask)
+        if any(m is not None for m in masks):
+            mask = np.concatenate(
+                [
+                    np.ones((len(texts), len(s)), dtype=bool) if m is None else m
+                    for m, s in zip(masks, scores)
+                ],
+                axis=1,
+            )
+            scores = np.concatenate(scores)
+            scores[~mask.T] = -np.inf
+            counts = mask.sum(axis=1).tolist()
+        else:
+            scores = np.concatenate(scores)
+            counts = [len(keys)] * len(texts)
+        results = []
+        rerank = self._rerank if self._precision != "float32" else 0
+        for query, q_scores, count in zip(queries, scores.T, counts):
+            k = min(similarity_top_k, count)
+            if k <= 0:
+                results.append([])
+                continue
+            if rerank:
+                # re-score the top candidates with the float32 embeddings
+                num = min(count, k * rerank)
+                top = np.argpartition(-q_scores, num - 1)[:num]
+                q_scores = q_scores.copy()
+                q_scores[top] = self._exact_scores([keys[i] for i in top.tolist()], query)
+                top = top[np.argsort(-q_scores[top], kind="stable")][:k]
+            else:
+                top = np.argpartition(-q_scores, k - 1)[:k]
+                top = top[np.argsort(-q_scores[top], kind="stable")]
+            nodes = []
+            for idx in top.tolist():
+                node_type, row = keys[idx]
+                nodes.append(self._partitions[node_type].node(row, float(q_scores[idx])))
+            results.append(nodes)
+        return results
+
+    def save(self, path=None):
+        """Save the index, only the changes are appended as a segment if possible"""
+
+        self.flush()
+        path = path or self._path
+        compact = (
+            path != self._path
+            or not os.path.exists(os.path.join(path, self.NODES))
+            or self._segments >= self._compact_segments
+        )
+        if not compact and not self._added and not self._removed and not self._updated:
+            return
+        writer = utils.get_writer()
+        if compact:
+            data = self.get_state()
+            # matrices are written to new files, unchanged vectors are kept
+            generation = int(time.time() * 1000)
+            files = {}
+            for idx, (node_type, partition) in enumerate(data["partitions"].items()):
+                source = partition["vectors"].source
+                if source and os.path.dirname(source) == path:
+                    vectors = os.path.basename(source)
+                else:
+                    vectors = "vectors_{}_{}.npy".format(generation, idx)
+                columns = "columns_{}_{}.npy".format(generation, idx)
+                files[node_type] = {"vectors": vectors, "columns": columns}
+                if path == self._path:
+                    self._partitions[node_type].vectors.source = os.path.join(
+                        path, vectors
+                    )
+            if writer:
+                writer.submit(self._write, data, path, files)
+            else:
+                self._write(data, path, files)
+            if path == self._path:
+                self._segments = 0
+        else:
+            segment = self._segment()
+            if writer:
+                writer.submit(self._append_segment, segment, path)
+            else:
+                self._append_segment(segment, path)
+            self._segments += 1
+        if path == self._path:
+            self._added, self._removed, self._updated = [], [], {}
+
+    def get_state(self):
+        """State of the index, used to restore without loading the files"""
+
+        self.flush()
+        return {
+            "config": dict(self._config),
+            "partitions": {
+                node_type: {
+                    "ids": list(p.ids),
+                    "texts": list(p.texts),
+                    "infos": list(p.infos),
+                    "vectors": p.vectors.snapshot(),
+                    "columns": {k: c.copy() for k, c in p.columns.items()},
+                }
+                for node_type, p in self._partitions.items()
+            },
+            "segments": self._segments,
+        }
+
+    def _segment(self):
+        added = []
+        for node_id in self._added:
+            node_type, row = self._rows[node_id]
+            partition = self._partitions[node_type]
+            node = partition.node(row)
+            added.append(
+                {
+                    "id": node_id,
+                    "text": node.text,
+                    "metadata": to_metadata(node.info, node.columns),
+                    "embedding": partition.embedding(row).tolist(),
+                }
+            )
+        return {
+            "add": added,
+            "remove": list(self._removed),
+            "update": {k: dict(v) for k, v in self._updated.items()},
+            "config": dict(self._config),
+        }
+
+    def _restore(self, state):
+        partitions = {}
+        for node_type, data in state["partitions"].items():
+            vectors = data["vectors"]
+            if isinstance(vectors, (MappedVectors, QuantizedVectors)):
+                # the saved files may have been replaced since the state
+                vectors = vectors.snapshot()
+                vectors.source = None
+            else:
+                vectors = MappedVectors.from_array(vectors)
+            vectors = self._convert(vectors)
+            partitions[node_type] = Partition(**{**data, "vectors": vectors})
+        self._set_partitions(state["config"], partitions)
+        self._segments = state.get("segments", 0)
+
+    def _set_partitions(self, config, partitions):
+        self._config = dict(config)
+        self._ann = {}
+        for node_type, partition in partitions.items():
+            self._partitions[node_type] = partition
+            for row, node_id in enumerate(partition.ids):
+                self._rows[node_id] = (node_type, row)
+
+    @classmethod
+    def _write(cls, data, path, files):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # the nodes file is replaced last so it always points to complete matrices
+        partitions = {}
+        for node_type, partition in data["partitions"].items():
+            file = os.path.join(path, files[node_type]["vectors"])
+            if not os.path.exists(file):
+                partition["vectors"].save(file)
+            columns = np.zeros(
+                len(partition["ids"]), dtype=[(k, d) for k, d in COLUMNS.items()]
+            )
+            for key, values in partition["columns"].items():
+                columns[key] = values
+            np.save(os.path.join(path, files[node_type]["columns"]), columns)
+            partitions[node_type] = {
+                "file": files[node_type]["vectors"],
+                "columns": files[node_type]["columns"],
+                "precision": getattr(partition["vectors"], "precision", "float32"),
+                "nodes": [
+                    [node_id, text, info]
+                    for node_id, text, info in zip(
+                        partition["ids"], partition["texts"], partition["infos"]
+                    )
+                ],
+            }
+        nodes = {"config": data["config"], "partitions": partitions}
+        utils.save_dict(nodes, os.path.join(path, cls.NODES + ".tmp"))
+        os.replace(os.path.join(path, cls.NODES + ".tmp"), os.path.join(path, cls.NODES))
+        segments = os.path.join(path, cls.SEGMENTS)
+        if os.path.exists(segments):
+            os.remove(segments)
+        stems = {f.split(".")[0] for p in files.values() for f in p.values()}
+        for f in os.listdir(path):
+            if not f.startswith(("vectors_", "columns_")) or f.split(".")[0] in stems:
+                continue
+            try:
+                os.remove(os.path.join(path, f))
+            except OSError:
+                # still mapped on some platforms, removed by a later save
+                pass
+
+    @classmethod
+    def _append_segment(cls, segment, path):
+        with open(os.path.join(path, cls.SEGMENTS), "a", encoding="utf-8") as f:
+            f.write(json.dumps(segment, ensure_ascii=False) + "\n")
+
+    def _load(self, path):
+        """Load the nodes, the matrices are mapped when they are first used"""
+
+        data = utils.load_dict(os.path.join(path, self.NODES))
+        partitions = {}
+        for node_type, partition in data["partitions"].items():
+            nodes = partition["nodes"]
+            file = os.path.join(path, partition["file"])
+            precision = partition.get("precision", "float32")
+            if precision == "float32":
+                vectors = MappedVectors(file, len(nodes))
+            else:
+                vectors = QuantizedVectors.load(
+                    file, len(nodes), precision, exact=self._rerank > 0
+                )
+            columns = np.load(os.path.join(path, partition["columns"]))
+            partitions[node_type] = Partition(
+                ids=[n[0] for n in nodes],
+                texts=[n[1] for n in nodes],
+                infos=[n[2] for n in nodes],
+                vectors=self._convert(vectors),
+                columns={k: np.array(columns[k]) for k in COLUMNS},
+            )
+        self._set_partitions(data["config"], partitions)
+
+    def _load_segments(self, path):
+        segments = os.path.join(path, self.SEGMENTS)
+        if not os.path.exists(segments):
+            return
+        with open(segments, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                segment = json.loads(line)
+                # nodes of a segment may be in the matrices already, if the
+                # segments were not removed after the last compaction
+                added = [a for a in segment["add"] if a["id"] not in self._rows]
+                if added:
+                    self._insert(
+                        [VectorNode.from_metadata(a["id"], a["text"], a["metadata"]) for a in added],
+                        np.array([a["embedding"] for a in added], dtype=np.float32),
+                    )
+                self.remove_nodes(segment["remove"])
+                for node_id, metadata in segment.get("update", {}).items():
+                    self.update_metadata([node_id], metadata)
+                self._config = segment["config"]
+                self._segments += 1
+        self._added, self._removed, self._updated = [], [], {}
+
+    @property
+    def nodes_num(self):
+        return len(self._rows) + len(self._pending)
@@ -0,0 +1,147 @@
+"""generative_agents.storage.quantize"""
+
+import os
+import numpy as np
+
+from .vectors import MappedVectors
+
+
+PRECISIONS = {"float16": np.float16, "int8": np.int8}
+
+
+def quantize(vectors, precision):
+    """Encode float32 vectors, return the codes and the scale of each vector"""
+
+    if precision == "int8":
+        scales = np.abs(vectors).max(axis=1, keepdims=True) / 127
+        scales = np.where(scales > 0, scales, 1).astype(np.float32)
+        return np.round(vectors / scales).astype(np.int8), scales
+    return vectors.astype(PRECISIONS[precision]), None
+
+
+def dequantize(codes, scales=None):
+    vectors = codes.astype(np.float32)
+    if scales is not None:
+        vectors *= scales
+    return vectors
+
+
+def part_file(path, part):
+    """File of a part of the vectors saved as path, e.g. vectors_1_0.scale.npy"""
+
+    root, ext = os.path.splitext(path)
+    return "{}.{}{}".format(root, part, ext)
+
+
+class QuantizedVectors:
+    """Vectors stored as float16, or as int8 with a scale per vector
+
+    Codes and scales are MappedVectors with the same rows, so they are mapped,
+    appended and removed together. With exact, the float32 vectors are kept as
+    a third part, which stays on disk until the top candidates of a query are
+    re-scored with it.
+
+    Queries are scored from the codes, converted in small chunks of rows into a
+    reused float32 block, so no float32 copy of the vectors is kept in memory.
+    """
+
+    def __init__(self, precision, codes=None, scales=None, exact=None):
+        self.precision = precision
+        if codes is None:
+            codes = MappedVectors(dtype=PRECISIONS[precision])
+        self._codes = codes
+        self._scales = scales
+        if precision == "int8" and scales is None:
+            self._scales = MappedVectors(dtype=np.float32)
+        self._exact = exact
+
+    @classmethod
+    def create(cls, precision, exact=False):
+        return cls(precision, exact=MappedVectors() if exact else None)
+
+    @classmethod
+    def load(cls, path, size, precision, exact=False):
+        """Map the parts saved as path, exact is kept only when it was saved"""
+
+        scales, exact_file = None, part_file(path, "exact")
+        if precision == "int8":
+            scales = MappedVectors(part_file(path, "scale"), size, dtype=np.float32)
+        if exact and os.path.exists(exact_file):
+            exact = MappedVectors(exact_file, size)
+        else:
+            exact = None
+        codes = MappedVectors(path, size, dtype=PRECISIONS[precision])
+        return cls(precision, codes, scales, exact)
+
+    def _parts(self):
+        parts = {"": self._codes, "scale": self._scales, "exact": self._exact}
+        return {k: v for k, v in parts.items() if v is not None}
+
+    @property
+    def exact(self):
+        """The float32 vectors, None when they are not kept"""
+
+        return self._exact
+
+    @property
+    def source(self):
+        return self._codes.source
+
+    @source.setter
+    def source(self, path):
+        for part, vectors in self._parts().items():
+            vectors.source = part_file(path, part) if path and part else path
+
+    def append(self, vectors):
+        codes, scales = quantize(vectors, self.precision)
+        self._codes.append(codes)
+        if self._scales is not None:
+            self._scales.append(scales)
+        if self._exact is not None:
+            self._exact.append(vectors)
+
+    def remove(self, row):
+        for vectors in self._parts().values():
+            vectors.remove(row)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, rows):
+        scales = self._scales[rows] if self._scales is not None else None
+        return dequantize(self._codes[rows], scales)
+
+    def dot(self, rows, queries, chunk=256):
+        """Scores of rows against queries, computed from the codes in chunks of rows
+
+        A chunk of codes is converted into the same float32 block, small enough
+        to stay in the CPU cache, and the int8 scales are applied to the scores.
+        """
+
+        queries = np.asarray(queries, dtype=np.float32)
+        scores = np.empty((len(rows), len(queries)), dtype=np.float32)
+        block = np.empty((min(chunk, len(rows)), queries.shape[1]), dtype=np.float32)
+        for start in range(0, len(rows), chunk):
+            part = rows[start : start + chunk]
+            codes = block[: len(part)]
+            np.copyto(codes, self._codes[part], casting="unsafe")
+            out = scores[start : start + len(part)]
+            np.matmul(codes, queries.T, out=out)
+            if self._scales is not None:
+                out *= self._scales[part]
+        return scores
+
+    def exact_dot(self, rows, queries):
+        """Scores of rows against queries with the float32 vectors"""
+
+        return self._exact.dot(rows, queries)
+
+    def snapshot(self):
+        parts = {k: v.snapshot() for k, v in self._parts().items()}
+        return QuantizedVectors(
+            self.precision, parts[""], parts.get("scale"), parts.get("exact")
+        )
+
+    def save(self, path):
+        for part, vectors in self._parts().items():
+            vectors.save(part_file(path, part) if part else path)
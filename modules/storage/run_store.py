@@ -0,0 +1,157 @@
+"""generative_agents.storage.run_store"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+
+class RunStore:
+    """SQLite store of the per-step agent states and conversations of a run"""
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS steps ("
+        "step INTEGER PRIMARY KEY, time TEXT, stride INTEGER, forward INTEGER, "
+        "file TEXT, keyframe TEXT)",
+        "CREATE TABLE IF NOT EXISTS agents ("
+        "step INTEGER, time TEXT, agent TEXT, x INTEGER, y INTEGER, "
+        "address TEXT, describe TEXT, event TEXT, schedule_hash TEXT, "
+        "PRIMARY KEY (step, agent))",
+        "CREATE TABLE IF NOT EXISTS conversations ("
+        "step INTEGER, time TEXT, title TEXT, chats TEXT)",
+        "CREATE INDEX IF NOT EXISTS steps_time ON steps (time)",
+        "CREATE INDEX IF NOT EXISTS agents_time ON agents (time)",
+        "CREATE INDEX IF NOT EXISTS agents_agent ON agents (agent, step)",
+        "CREATE INDEX IF NOT EXISTS conversations_step ON conversations (step)",
+        "CREATE INDEX IF NOT EXISTS conversations_time ON conversations (time)",
+    ]
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for sql in self.SCHEMA:
+            self._conn.execute(sql)
+        self._conn.commit()
+
+    def add_step(self, config, file, keyframe, chats=None):
+        """Add a step from the checkpoint config and the chats of the step"""
+
+        step, time = config["step"], config["time"]
+        rows = []
+        for name, agent in config["agents"].items():
+            event = agent.get("action", {}).get("event", {})
+            schedule = json.dumps(agent.get("schedule"), ensure_ascii=False, sort_keys=True)
+            rows.append(
+                (
+                    step,
+                    time,
+                    name,
+                    agent["coord"][0],
+                    agent["coord"][1],
+                    ":".join(event.get("address", [])),
+                    event.get("describe", ""),
+                    json.dumps(event, ensure_ascii=False),
+                    hashlib.sha1(schedule.encode("utf-8")).hexdigest()[:16],
+                )
+            )
+        conversations = [
+            (step, time, title, json.dumps(c, ensure_ascii=False))
+            for chat in chats or []
+            for title, c in chat.items()
+        ]
+        with self._lock:
+            self._conn.execute("DELETE FROM conversations WHERE step=?", (step,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?)",
+                (step, time, config["stride"], config.get("forward", config["stride"]), file, keyframe),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO agents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.executemany(
+                "INSERT INTO conversations VALUES (?, ?, ?, ?)", conversations
+            )
+            self._conn.commit()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def last_step(self):
+        rows = self._query("SELECT * FROM steps ORDER BY step DESC LIMIT 1")
+        if not rows:
+            return None
+        keys = ["step", "time", "stride", "forward", "file", "keyframe"]
+        return dict(zip(keys, rows[0]))
+
+    def covers(self, step):
+        """Check if every step from the first step of the run to step is stored"""
+
+        first, last, count = self._query("SELECT MIN(step), MAX(step), COUNT(*) FROM steps")[0]
+        return first == 1 and last is not None and last >= step and count == last
+
+    def checkpoint_files(self, step=None):
+        """Get the checkpoint files from the keyframe of a step to the step"""
+
+        if step is None:
+            last = self.last_step()
+            if not last:
+                return []
+            step = last["step"]
+        rows = self._query(
+            "SELECT file FROM steps WHERE step<=? AND step>=("
+            "SELECT step FROM steps WHERE file=(SELECT keyframe FROM steps WHERE step=?)"
+            ") ORDER BY step",
+            (step, step),
+        )
+        folder = os.path.dirname(self._path)
+        return [os.path.join(folder, r[0]) for r in rows]
+
+    def iter_steps(self):
+        """Iterate the steps in the format of checkpoints, only action events are kept"""
+
+        steps = self._query("SELECT step, time, stride, forward FROM steps ORDER BY step")
+        for step, time, stride, forward in steps:
+            rows = self._query(
+                "SELECT agent, x, y, event FROM agents WHERE step=? ORDER BY rowid",
+                (step,),
+            )
+            yield {
+                "step": step,
+                "time": time,
+                "stride": stride,
+                "forward": forward,
+                "agents": {
+                    agent: {"coord": [x, y], "action": {"event": json.loads(event)}}
+                    for agent, x, y, event in rows
+                },
+            }
+
+    def get_conversation(self):
+        """Get conversations in the format of ConversationLog"""
+
+        conversation = {}
+        rows = self._query("SELECT time, title, chats FROM conversations ORDER BY rowid")
+        for time, title, chats in rows:
+            conversation.setdefault(time, []).append({title: json.loads(chats)})
+        return conversation
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @property
+    def path(self):
+        return self._path
+
+
+def open_run_store(checkpoints_folder, create=False):
+    """Open the run store of a simulation, None if it does not exist"""
+
+    path = os.path.join(checkpoints_folder, "run.db")
+    if not create and not os.path.exists(path):
+        return None
+    return RunStore(path)
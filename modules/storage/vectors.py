@@ -0,0 +1,145 @@
+"""generative_agents.storage.vectors"""
+
+import numpy as np
+
+
+class MappedVectors:
+    """Rows of a matrix, held in a memory-mapped base file and a tail
+
+    The base file is opened on the first access and paged by the OS, it is never
+    written, so the vectors of an agent cost no memory until they are used.
+    Appended rows go to the in-memory tail, and a removed row takes the slot of
+    the last row, so each row is mapped to a slot of the base or the tail.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        size=0,
+        base=None,
+        tail=None,
+        tail_size=0,
+        slots=None,
+        dtype=np.float32,
+    ):
+        self._path = path
+        self._base = base
+        self._base_size = size if base is None else len(base)
+        self.dtype = np.dtype(dtype)
+        self._tail = tail if tail is not None else np.zeros((0, 0), dtype=self.dtype)
+        self._tail_size = tail_size
+        if slots is None:
+            slots = np.arange(self._base_size, dtype=np.int64)
+        self._slots, self._size = slots, len(slots)
+        # saved file with the same rows, reused when the index is saved again
+        self.source = path
+
+    @classmethod
+    def from_array(cls, vectors, dtype=np.float32):
+        return cls(base=np.ascontiguousarray(vectors, dtype=dtype), dtype=dtype)
+
+    def _open(self):
+        if self._base is None:
+            if self._path:
+                self._base = np.load(self._path, mmap_mode="r")
+            else:
+                self._base = np.zeros((0, 0), dtype=self.dtype)
+        return self._base
+
+    @property
+    def dim(self):
+        base = self._open()
+        if self._base_size:
+            return base.shape[1]
+        return self._tail.shape[1]
+
+    def append(self, vectors):
+        size = len(vectors)
+        if self.dim != vectors.shape[1]:
+            assert self._size == 0, "Embedding dimension changed"
+            self._base, self._base_size = np.zeros((0, vectors.shape[1]), self.dtype), 0
+            self._tail = np.zeros((0, vectors.shape[1]), dtype=self.dtype)
+            self._tail_size = 0
+        if self._tail_size + size > len(self._tail):
+            # a new tail is allocated, so the rows held by snapshots are unchanged
+            capacity = max(self._tail_size + size, len(self._tail) * 2, 16)
+            grown = np.zeros((capacity, vectors.shape[1]), dtype=self.dtype)
+            if self._tail_size:
+                grown[: self._tail_size] = self._tail[: self._tail_size]
+            self._tail = grown
+        if self._size + size > len(self._slots):
+            grown = np.zeros(max(self._size + size, len(self._slots) * 2, 16), np.int64)
+            grown[: self._size] = self._slots[: self._size]
+            self._slots = grown
+        self._tail[self._tail_size : self._tail_size + size] = vectors
+        self._slots[self._size : self._size + size] = np.arange(
+            self._base_size + self._tail_size, self._base_size + self._tail_size + size
+        )
+        self._tail_size += size
+        self._size += size
+        self.source = None
+
+    def remove(self, row):
+        """Remove a row by moving the last row into it"""
+
+        self._size -= 1
+        self._slots[row] = self._slots[self._size]
+        self.source = None
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, rows):
+        base = self._open()
+        slots = self._slots[: self._size][rows]
+        if not len(slots):
+            return np.zeros((0, self.dim), dtype=self.dtype)
+        first, last = int(slots[0]), int(slots[-1])
+        if last < self._base_size and last - first == len(slots) - 1:
+            if (np.diff(slots) == 1).all():
+                return base[first : last + 1]
+        in_base = slots < self._base_size
+        vectors = np.empty((len(slots), self.dim), dtype=self.dtype)
+        if in_base.any():
+            vectors[in_base] = base[slots[in_base]]
+        if not in_base.all():
+            vectors[~in_base] = self._tail[slots[~in_base] - self._base_size]
+        return vectors
+
+    def dot(self, rows, queries, chunk=16384):
+        """Scores of rows against queries, computed in chunks of rows"""
+
+        scores = np.zeros((len(rows), len(queries)), dtype=np.float32)
+        for start in range(0, len(rows), chunk):
+            block = self[rows[start : start + chunk]]
+            scores[start : start + chunk] = block @ queries.T
+        return scores
+
+    def snapshot(self):
+        """Copy that keeps the current rows, the base and tail are shared"""
+
+        vectors = MappedVectors(
+            self._path,
+            self._base_size,
+            self._open(),
+            self._tail,
+            self._tail_size,
+            self._slots[: self._size].copy(),
+            self.dtype,
+        )
+        vectors.source = self.source
+        return vectors
+
+    def save(self, path, chunk=16384):
+        """Save the rows as a .npy file, written in chunks of rows"""
+
+        if not self._size:
+            np.save(path, np.zeros((0, self.dim), dtype=self.dtype))
+            return
+        data = np.lib.format.open_memmap(
+            path, mode="w+", dtype=self.dtype, shape=(self._size, self.dim)
+        )
+        for start in range(0, self._size, chunk):
+            data[start : start + chunk] = self[slice(start, start + chunk)]
+        data.flush()
+        del data
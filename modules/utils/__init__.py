@@ -5,3 +5,8 @@ from .log import *
 from .namespace import *
 from .register import *
 from .timer import *
+from .cassette import *
+from .embed_cache import *
+from .writer import *
+from .checkpoint import *
+from .conversation import *
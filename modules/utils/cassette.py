@@ -0,0 +1,125 @@
+"""generative_agents.utils.cassette"""
+
+import os
+import json
+import array
+import sqlite3
+import hashlib
+import threading
+
+from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+class Cassette:
+    """Record/replay store for completions and embeddings
+
+    In "record" mode every call goes to the live model and the result is stored.
+    In "replay" mode stored results are returned without calling the model, calls
+    that were never recorded fall through to the live model and are recorded.
+    Identical calls are stored as a sequence and replayed in the same order.
+    """
+
+    def __init__(self, path, mode="replay"):
+        assert mode in ("record", "replay"), "Unknown cassette mode " + str(mode)
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._path = path
+        self._mode = mode
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS calls ("
+            "key TEXT, seq INTEGER, kind TEXT, value BLOB, PRIMARY KEY (key, seq))"
+        )
+        self._conn.commit()
+        self._seqs = {}
+        self._summary = {"hit": 0, "miss": 0}
+
+    def _make_key(self, kind, *parts):
+        data = json.dumps([kind, *parts], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def _next_seq(self, key):
+        seq = self._seqs.get(key, 0)
+        self._seqs[key] = seq + 1
+        return seq
+
+    def _load(self, key, seq):
+        row = self._conn.execute(
+            "SELECT value FROM calls WHERE key=? AND seq<=? ORDER BY seq DESC LIMIT 1",
+            (key, seq),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _store(self, key, seq, kind, value):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?)", (key, seq, kind, value)
+        )
+        self._conn.commit()
+
+    def _play(self, kind, key, call, encode, decode):
+        with self._lock:
+            seq = self._next_seq(key)
+            if self._mode == "replay":
+                value = self._load(key, seq)
+                if value is not None:
+                    self._summary["hit"] += 1
+                    return decode(value)
+            self._summary["miss"] += 1
+        result = call()
+        if result is not None:
+            with self._lock:
+                self._store(key, seq, kind, encode(result))
+        return result
+
+    def completion(self, call, model, caller, prompt, **kwargs):
+        """Play a completion, call() is used when the record is missing"""
+
+        key = self._make_key("completion", model, caller, prompt, kwargs)
+        return self._play(
+            "completion",
+            key,
+            call,
+            lambda r: json.dumps(r, ensure_ascii=False, default=str).encode("utf-8"),
+            lambda v: json.loads(v.decode("utf-8")),
+        )
+
+    def embedding(self, call, model, text):
+        """Play an embedding, call() is used when the record is missing"""
+
+        key = self._make_key("embedding", model, text)
+        return self._play(
+            "embedding",
+            key,
+            call,
+            lambda r: array.array("f", r).tobytes(),
+            lambda v: array.array("f", v).tolist(),
+        )
+
+    def get_summary(self):
+        return {"mode": self._mode, **self._summary}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @property
+    def mode(self):
+        return self._mode
+
+
+def set_cassette(path="", mode="off"):
+    if not path or mode == "off":
+        GenerativeAgentsMap.delete(GenerativeAgentsKey.CASSETTE)
+        return None
+    cassette = GenerativeAgentsMap.get(GenerativeAgentsKey.CASSETTE)
+    if cassette and cassette._path == path and cassette.mode == mode:
+        return cassette
+    GenerativeAgentsMap.set(GenerativeAgentsKey.CASSETTE, Cassette(path, mode))
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.CASSETTE)
+
+
+def get_cassette():
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.CASSETTE)
@@ -0,0 +1,116 @@
+"""generative_agents.utils.checkpoint"""
+
+import os
+import json
+import copy
+
+from .writer import write_json
+
+DELETE_KEY = "__delete__"
+
+
+def diff_dict(old, new):
+    """Get the patch that turns old into new, nested dicts are diffed recursively"""
+
+    patch = {}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            sub_patch = diff_dict(old[key], value)
+            if sub_patch:
+                patch[key] = sub_patch
+        elif value != old[key] or type(value) is not type(old[key]):
+            patch[key] = value
+    removed = [k for k in old if k not in new]
+    if removed:
+        patch[DELETE_KEY] = removed
+    return patch
+
+
+def patch_dict(base, patch):
+    """Apply the patch from diff_dict to base in place"""
+
+    for key, value in patch.items():
+        if key == DELETE_KEY:
+            for k in value:
+                base.pop(k, None)
+        elif isinstance(value, dict) and isinstance(base.get(key), dict):
+            patch_dict(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def save_checkpoint(path, config, base=None):
+    """Save config as a keyframe, or as a delta of base when base is given"""
+
+    if base is None:
+        write_json(path, config)
+    else:
+        delta = {
+            "time": config["time"],
+            "step": config["step"],
+            "delta": diff_dict(base, config),
+        }
+        write_json(path, delta, indent=None)
+
+
+def list_checkpoints(checkpoints_folder):
+    files = sorted(os.listdir(checkpoints_folder))
+    return [
+        os.path.join(checkpoints_folder, f)
+        for f in files
+        if f.startswith("simulate-") and f.endswith(".json")
+    ]
+
+
+def load_checkpoints(checkpoints_folder):
+    """Load all checkpoints in order, deltas are applied to the previous checkpoint"""
+
+    config = None
+    for path in list_checkpoints(checkpoints_folder):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if "delta" in data:
+            assert config is not None, "Missing keyframe before " + path
+            config = patch_dict(copy.deepcopy(config), data["delta"])
+        else:
+            config = data
+        yield path, config
+
+
+def load_checkpoint(checkpoints_folder, index=-1, files=None):
+    """Load a checkpoint by applying deltas to the nearest keyframe before it"""
+
+    files = files or list_checkpoints(checkpoints_folder)
+    if not files:
+        return None
+    index = index % len(files)
+    datas = []
+    for path in reversed(files[: index + 1]):
+        with open(path, "r", encoding="utf-8") as f:
+            datas.append(json.load(f))
+        if "delta" not in datas[-1]:
+            break
+    config = datas.pop()
+    assert "delta" not in config, "Missing keyframe before " + files[index]
+    for data in reversed(datas):
+        patch_dict(config, data["delta"])
+    return config
+
+
+def save_manifest(checkpoints_folder, manifest):
+    """Save the manifest of the latest checkpoint, replaced atomically"""
+
+    path = os.path.join(checkpoints_folder, "manifest.json")
+    write_json(path + ".tmp", manifest)
+    os.replace(path + ".tmp", path)
+
+
+def load_manifest(checkpoints_folder):
+    path = os.path.join(checkpoints_folder, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,80 @@
+"""generative_agents.utils.conversation"""
+
+import os
+import json
+import threading
+
+
+class ConversationLog(dict):
+    """Conversations keyed by time, appended to a JSON lines file as they happen
+
+    Each line holds one chat as {"time": key, "chat": {title: chats}}. The byte
+    offsets of the lines are indexed by time, so a single time can be read back
+    with read() without loading the whole log.
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        self._path = path
+        self._lock = threading.Lock()
+        self._offsets = {}
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                offset = f.tell()
+                for line in iter(f.readline, b""):
+                    if line.strip():
+                        record = json.loads(line)
+                        self.setdefault(record["time"], []).append(record["chat"])
+                        self._offsets.setdefault(record["time"], []).append(offset)
+                    offset = f.tell()
+
+    def append(self, key, chat):
+        with self._lock:
+            self.setdefault(key, []).append(chat)
+            if not self._path:
+                return
+            line = json.dumps({"time": key, "chat": chat}, ensure_ascii=False)
+            with open(self._path, "ab") as f:
+                self._offsets.setdefault(key, []).append(f.tell())
+                f.write((line + "\n").encode("utf-8"))
+
+    def read(self, key):
+        """Read the chats of a time from the file"""
+
+        chats = []
+        if not self._path or key not in self._offsets:
+            return chats
+        with open(self._path, "rb") as f:
+            for offset in self._offsets[key]:
+                f.seek(offset)
+                chats.append(json.loads(f.readline())["chat"])
+        return chats
+
+    @property
+    def path(self):
+        return self._path
+
+
+def convert_conversation(json_path, log_path):
+    """Convert a conversation.json file to a conversation log"""
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        conversation = json.load(f)
+    if os.path.exists(log_path + ".tmp"):
+        os.remove(log_path + ".tmp")
+    log = ConversationLog(log_path + ".tmp")
+    for key, chats in conversation.items():
+        for chat in chats:
+            log.append(key, chat)
+    os.replace(log_path + ".tmp", log_path)
+    return ConversationLog(log_path)
+
+
+def load_conversation(checkpoints_folder):
+    """Load the conversation log of a simulation, conversation.json is converted"""
+
+    log_path = os.path.join(checkpoints_folder, "conversation.jsonl")
+    json_path = os.path.join(checkpoints_folder, "conversation.json")
+    if not os.path.exists(log_path) and os.path.exists(json_path):
+        return convert_conversation(json_path, log_path)
+    return ConversationLog(log_path)
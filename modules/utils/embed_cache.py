@@ -0,0 +1,111 @@
+"""generative_agents.utils.embed_cache"""
+
+import os
+import json
+import array
+import sqlite3
+import hashlib
+import threading
+import collections
+
+from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+class EmbeddingCache:
+    """Content-hash keyed cache of embeddings
+
+    Recently used embeddings are kept in memory with LRU eviction, all embeddings
+    are stored in a SQLite file so they are shared across agents, processes and
+    runs. Embeddings are stored as float32, the same values are returned on both
+    hit and miss. The memory keeps the packed float32 arrays, they are converted
+    to lists only when returned.
+    """
+
+    def __init__(self, path="", capacity=4096):
+        self._path = path
+        self._capacity = max(capacity, 1)
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self._summary = {"hit": 0, "disk": 0, "miss": 0}
+        self._conn = None
+        if path:
+            folder = os.path.dirname(path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, value BLOB)"
+            )
+            self._conn.commit()
+
+    def make_key(self, model, kind, text):
+        data = json.dumps([model, kind, text], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._capacity:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Get the embedding of key, None if it is not cached"""
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._summary["hit"] += 1
+                return self._memory[key].tolist()
+            if self._conn:
+                row = self._conn.execute(
+                    "SELECT value FROM embeddings WHERE key=?", (key,)
+                ).fetchone()
+                if row:
+                    data = array.array("f", row[0])
+                    self._remember(key, data)
+                    self._summary["disk"] += 1
+                    return data.tolist()
+            self._summary["miss"] += 1
+            return None
+
+    def put(self, key, embedding):
+        """Cache the embedding of key, return it as stored"""
+
+        data = array.array("f", embedding)
+        with self._lock:
+            self._remember(key, data)
+            if self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?)", (key, data.tobytes())
+                )
+                self._conn.commit()
+        return data.tolist()
+
+    def get_summary(self):
+        return {**self._summary, "memory": len(self._memory)}
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    @property
+    def path(self):
+        return self._path
+
+
+def set_embed_cache(path="", capacity=4096, enable=True):
+    if not enable or capacity <= 0:
+        GenerativeAgentsMap.delete(GenerativeAgentsKey.EMBED_CACHE)
+        return None
+    cache = GenerativeAgentsMap.get(GenerativeAgentsKey.EMBED_CACHE)
+    if cache and cache.path == path:
+        return cache
+    GenerativeAgentsMap.set(GenerativeAgentsKey.EMBED_CACHE, EmbeddingCache(path, capacity))
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.EMBED_CACHE)
+
+
+def get_embed_cache():
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.EMBED_CACHE)
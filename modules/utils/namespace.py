@@ -42,6 +42,9 @@ class GenerativeAgentsKey:
     GAME = "game"
     TIMER = "timer"
     MODELS = "models"
+    CASSETTE = "cassette"
+    WRITER = "writer"
+    EMBED_CACHE = "embed_cache"
 
 
 class ModelType:
@@ -6,6 +6,8 @@ from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
 
 
 def to_date(date_str, date_format="%Y%m%d-%H:%M:%S"):
+    if isinstance(date_str, datetime.datetime):
+        return date_str
     if date_format == "%H:%M" and date_str.startswith("24:"):
         date_str = date_str.replace("24:", "0:")
     return datetime.datetime.strptime(date_str, date_format)
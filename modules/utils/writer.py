@@ -0,0 +1,99 @@
+"""generative_agents.utils.writer"""
+
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+
+from .namespace import GenerativeAgentsMap, GenerativeAgentsKey
+
+
+def write_json(path, data, indent=2):
+    folder = os.path.dirname(path)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data, indent=indent, ensure_ascii=False))
+
+
+class CheckpointWriter:
+    """Write checkpoints in a background thread
+
+    Jobs are queued with a bounded queue, so the simulation only blocks when the
+    writer falls behind by more than max_pending jobs. The time spent blocking is
+    recorded as the wait time.
+    """
+
+    def __init__(self, max_pending=2, logger=None):
+        self._queue = queue.Queue(maxsize=max(max_pending, 1))
+        self._logger = logger
+        self._summary = {"jobs": 0, "wait": 0.0, "write": 0.0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                start = time.time()
+                func(*args)
+                self._summary["write"] += time.time() - start
+            except Exception:
+                self._summary["errors"] += 1
+                msg = "CheckpointWriter caused an error:\n" + traceback.format_exc()
+                if self._logger:
+                    self._logger.error(msg)
+                else:
+                    print(msg)
+            finally:
+                self._queue.task_done()
+
+    def _wait(self, func, *args):
+        start = time.time()
+        func(*args)
+        self._summary["wait"] += time.time() - start
+
+    def submit(self, func, *args):
+        self._summary["jobs"] += 1
+        self._wait(self._queue.put, (func, args))
+
+    def write_json(self, path, data, indent=2):
+        self.submit(write_json, path, data, indent)
+
+    def flush(self):
+        self._wait(self._queue.join)
+
+    def close(self):
+        if not self._thread.is_alive():
+            return
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def get_summary(self):
+        return {
+            "jobs": self._summary["jobs"],
+            "pending": self._queue.qsize(),
+            "wait": round(self._summary["wait"], 3),
+            "write": round(self._summary["write"], 3),
+            "errors": self._summary["errors"],
+        }
+
+
+def set_writer(max_pending=0, logger=None):
+    writer = GenerativeAgentsMap.delete(GenerativeAgentsKey.WRITER)
+    if writer:
+        writer.close()
+    if max_pending <= 0:
+        return None
+    GenerativeAgentsMap.set(GenerativeAgentsKey.WRITER, CheckpointWriter(max_pending, logger))
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.WRITER)
+
+
+def get_writer():
+    return GenerativeAgentsMap.get(GenerativeAgentsKey.WRITER)
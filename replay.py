@@ -4,7 +4,7 @@ import collections
 from datetime import datetime, timedelta
 from flask import Flask, render_template, request
 
-from compress import frames_per_step, file_movement
+from compress import frames_per_step, file_movement, load_steps, load_conversation, count_steps
 from start import personas
 
 app = Flask(
@@ -77,12 +77,12 @@ def interaction_graph():
         return f"Invalid name of the simulation: '{name}'"
 
     # 讀取對話數據
-    conversation_file = f"{checkpoint_folder}/conversation.json"
-    if not os.path.exists(conversation_file):
+    conversation_file = f"{checkpoint_folder}/conversation.jsonl"
+    if not os.path.exists(conversation_file) and not os.path.exists(f"{checkpoint_folder}/conversation.json"):
         return f"The conversation file doesn't exist: '{conversation_file}'"
 
-    with open(conversation_file, "r", encoding="utf-8") as f:
-        conversation_data = json.load(f)
+    # 存在run.db時直接查詢，舊版的conversation.json會被轉換為conversation.jsonl
+    conversation_data = load_conversation(checkpoint_folder)
 
     # 計算角色之間的互動次數和對話長度
     interaction_count = collections.defaultdict(int)  # 互動次數
@@ -233,26 +233,20 @@ def object_interaction():
     location_interactions = collections.defaultdict(int)
     action_details = collections.defaultdict(list)  # 記錄詳細的動作信息
 
-    # 讀取所有checkpoint文件
-    try:
-        checkpoint_files = [f for f in os.listdir(checkpoint_folder) 
-                           if f.startswith("simulate-") and f.endswith(".json")]
-        checkpoint_files.sort()  # 按時間順序排序
-    except FileNotFoundError:
+    if not os.path.isdir(checkpoint_folder):
         return f"Checkpoint folder not found: '{checkpoint_folder}'"
-    
-    if not checkpoint_files:
+
+    # 步數從清單中讀取
+    steps = count_steps(checkpoint_folder)
+    if not steps:
         return f"No simulation data found in: '{checkpoint_folder}'"
 
-    print(f"Found {len(checkpoint_files)} checkpoint files")
+    print(f"Found {steps} steps")
 
-    # 分析每個checkpoint文件
-    for checkpoint_file in checkpoint_files:
-        file_path = os.path.join(checkpoint_folder, checkpoint_file)
+    # 分析每個checkpoint（存在run.db時直接查詢）
+    for data in load_steps(checkpoint_folder):
+        checkpoint_file = data.get("time", "")
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            
             # 分析agents數據
             if "agents" in data:
                 for agent_name, agent_data in data["agents"].items():
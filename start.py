@@ -1,12 +1,17 @@
 import os
 import copy
 import json
+import time
+import pickle
 import argparse
 import datetime
+import concurrent.futures
 
 from dotenv import load_dotenv, find_dotenv
 
 from modules.game import create_game, get_game
+from modules.shard import ShardGame
+from modules.storage.run_store import open_run_store
 from modules import utils
 
 personas = [
@@ -17,7 +22,7 @@ personas = [
 
 
 class SimulateServer:
-    def __init__(self, name, static_root, checkpoints_folder, config, start_step=0, verbose="info", log_file=""):
+    def __init__(self, name, static_root, checkpoints_folder, config, start_step=0, verbose="info", log_file="", snapshot=None):
         self.name = name
         self.static_root = static_root
         self.checkpoints_folder = checkpoints_folder
@@ -27,24 +32,29 @@ class SimulateServer:
 
         os.makedirs(checkpoints_folder, exist_ok=True)
 
-        # 載入歷史對話數據（用於斷點恢复）
-        self.conversation_log = f"{checkpoints_folder}/conversation.json"
-        if os.path.exists(self.conversation_log):
-            with open(self.conversation_log, "r", encoding="utf-8") as f:
-                conversation = json.load(f)
-        else:
-            conversation = {}
+        # 載入歷史對話數據（用於斷點恢复），對話產生時即追加寫入conversation.jsonl
+        conversation = utils.load_conversation(checkpoints_folder)
+        self.conversation_log = conversation.path
 
         if len(log_file) > 0:
             self.logger = utils.create_file_logger(f"{checkpoints_folder}/{log_file}", verbose)
         else:
             self.logger = utils.create_io_logger(verbose)
 
-        # 创建游戲
-        game = create_game(name, static_root, config, conversation, logger=self.logger)
-        game.reset_game(keys=config["api_keys"])
+        # 分片數（>1 時Agent分布在多個進程中運行）
+        self.shards = config.get("simulate", {}).get("shards", 1)
 
-        self.game = get_game()
+        # 创建游戲
+        if self.shards > 1:
+            log_path = f"{checkpoints_folder}/{log_file}" if len(log_file) > 0 else None
+            self.game = ShardGame(
+                name, static_root, config, conversation, self.shards,
+                logger=self.logger, log_path=log_path, verbose=verbose,
+            )
+        else:
+            game = create_game(name, static_root, config, conversation, logger=self.logger, snapshot=snapshot)
+            game.reset_game(keys=config["api_keys"])
+            self.game = get_game()
         self.tile_size = self.game.maze.tile_size
         self.agent_status = {}
         if "agent_base" in config:
@@ -58,69 +68,249 @@ class SimulateServer:
                 "coord": agent_config["coord"],
                 "path": [],
             }
+            if snapshot and self.shards <= 1:
+                self.agent_status[agent_name] = snapshot["agents"][agent_name]["status"]
         self.think_interval = max(
             a.think_config["interval"] for a in self.game.agents.values()
         )
         self.start_step = start_step
 
-    def simulate(self, step, stride=0):
+        # 並行思考的線程數（<=1 時依次思考）
+        self.workers = config.get("simulate", {}).get("workers", 1)
+        # 因空閒而跳過思考的Agent步數
+        self.skipped = 0
+        # 後台寫入存檔的隊列長度（<=0 時同步寫入）
+        self.writer = utils.set_writer(
+            config.get("simulate", {}).get("checkpoint_queue", 0), self.logger
+        )
+        # 每隔多少步保存一個完整存檔，其餘步只保存與上一步的差異（<=1 時每步完整保存）
+        self.keyframe = config.get("simulate", {}).get("checkpoint_keyframe", 1)
+        self.last_checkpoint, self.last_keyframe = None, 0
+        self.keyframe_file, self.keyframe_chain = None, []
+        # 每隔多少步保存恢复快照（<=0 時只在模擬結束時保存），分片模式下不保存
+        self.snapshot_interval = config.get("simulate", {}).get("resume_snapshot", 0)
+        self.snapshot_step = snapshot["step"] if snapshot else 0
+        # 可選的SQLite存儲，保存每步的Agent狀態與對話，供分析工具查詢
+        self.store = None
+        if config.get("simulate", {}).get("run_store", False):
+            self.store = open_run_store(checkpoints_folder, create=True)
+
+    def simulate(self, step, stride=0, mode="stride"):
         timer = utils.get_timer()
-        for i in range(self.start_step, self.start_step + step):
-            title = "Simulate Step[{}/{}, time: {}]".format(i+1, self.start_step + step, timer.get_date())
-            self.logger.info("\n" + utils.split_line(title, "="))
-            for name, status in self.agent_status.items():
-                plan = self.game.agent_think(name, status)["plan"]
-                agent = self.game.get_agent(name)
-                if name not in self.config["agents"]:
-                    self.config["agents"][name] = {}
-                self.config["agents"][name].update(agent.to_dict())
-                if plan.get("path"):
-                    status["coord"], status["path"] = plan["path"][-1], []
-                self.config["agents"][name].update(
-                    # {"coord": status["coord"], "path": plan["path"]}
-                    {"coord": status["coord"]}
-                )
-
-            sim_time = timer.get_date("%Y%m%d-%H:%M")
-            self.config.update(
-                {
-                    "time": sim_time,
-                    "step": i + 1,
-                }
+        executor = None
+        if self.workers > 1 and self.shards <= 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for i in range(self.start_step, self.start_step + step):
+                title = "Simulate Step[{}/{}, time: {}]".format(i+1, self.start_step + step, timer.get_date())
+                self.logger.info("\n" + utils.split_line(title, "="))
+                forward = self.simulate_step(i, stride, mode, executor)
+                if forward > 0:
+                    timer.forward(forward)
+            # 模擬正常結束時保存恢复快照，用於快速斷點恢复
+            if self.shards <= 1 and step > 0 and self.snapshot_step < self.config["step"]:
+                self.save_snapshot()
+        finally:
+            if executor:
+                executor.shutdown()
+            # 確保所有存檔寫入完成
+            if self.writer:
+                self.writer.close()
+                self.logger.info("Checkpoint writer: {}".format(self.writer.get_summary()))
+            if self.shards > 1:
+                self.game.close()
+
+    def simulate_step(self, i, stride=0, mode="stride", executor=None):
+        timer = utils.get_timer()
+        start = time.time()
+        results = self.think(executor)
+        skipped = sum(1 for r in results.values() if r["info"]["skipped"])
+        self.skipped += skipped
+        self.logger.info(
+            "Step[{}] {} agents think cost {:.2f}s (workers: {}, skipped: {}, total skipped: {})".format(
+                i+1, len(results), time.time() - start, self.workers, skipped, self.skipped
             )
-            # 保存Agent活動數據
-            with open(f"{self.checkpoints_folder}/simulate-{sim_time.replace(':', '')}.json", "w", encoding="utf-8") as f:
-                f.write(json.dumps(self.config, indent=2, ensure_ascii=False))
-            # 保存對話數據
-            with open(f"{self.checkpoints_folder}/conversation.json", "w", encoding="utf-8") as f:
-                f.write(json.dumps(self.game.conversation, indent=2, ensure_ascii=False))
+        )
+        cassette = utils.get_cassette()
+        if cassette:
+            self.logger.info("Step[{}] cassette: {}".format(i+1, cassette.get_summary()))
+        embed_cache = utils.get_embed_cache()
+        if embed_cache:
+            self.logger.info("Step[{}] embedding cache: {}".format(i+1, embed_cache.get_summary()))
+        for name, status in self.agent_status.items():
+            plan = results[name]["plan"]
+            agent = self.game.get_agent(name)
+            if name not in self.config["agents"]:
+                self.config["agents"][name] = {}
+            self.config["agents"][name].update(agent.to_dict())
+            if plan.get("path"):
+                status["coord"], status["path"] = plan["path"][-1], []
+            self.config["agents"][name].update(
+                # {"coord": status["coord"], "path": plan["path"]}
+                {"coord": status["coord"]}
+            )
+
+        if mode == "event" and stride > 0:
+            forward = self.next_forward(stride)
+        else:
+            forward = stride
+
+        sim_time = timer.get_date("%Y%m%d-%H:%M")
+        self.config.update(
+            {
+                "time": sim_time,
+                "step": i + 1,
+                "forward": forward,
+            }
+        )
+        self.save_checkpoint(i, sim_time)
+        return forward
+
+    # 保存存檔（完整存檔或差異存檔）、SQLite存儲、恢复快照與清單，有後台寫入時交給後台完成
+    def save_checkpoint(self, i, sim_time):
+        checkpoint_file = f"{self.checkpoints_folder}/simulate-{sim_time.replace(':', '')}.json"
+        # 差異存檔以上一步的快照為基準，距離上一個完整存檔達到keyframe步時重新完整保存
+        base = None
+        if self.last_checkpoint is not None and i + 1 - self.last_keyframe < self.keyframe:
+            base = self.last_checkpoint
+        else:
+            self.last_keyframe = i + 1
+            self.keyframe_file = os.path.basename(checkpoint_file)
+            self.keyframe_chain = []
+        self.keyframe_chain.append(os.path.basename(checkpoint_file))
+        checkpoint = self.config
+        if self.writer or self.keyframe > 1:
+            checkpoint = copy.deepcopy(self.config)
+        if self.keyframe > 1:
+            self.last_checkpoint = checkpoint
+        self.submit(utils.save_checkpoint, checkpoint_file, checkpoint, base)
+        if self.store:
+            self.submit(self.store.add_step, checkpoint, *self.store_step(checkpoint_file, sim_time))
+        if self.shards <= 1 and self.snapshot_interval > 0 and (i + 1) % self.snapshot_interval == 0:
+            self.save_snapshot(checkpoint)
+        else:
+            self.save_manifest()
+        if self.writer:
+            self.logger.info("Step[{}] checkpoint writer: {}".format(i+1, self.writer.get_summary()))
+
+    # 保存恢复快照：完整的地圖事件與Agent狀態（坐標、路徑、記憶索引），恢复時一次讀取
+    def save_snapshot(self, checkpoint=None):
+        snapshot = {
+            "step": self.config["step"],
+            "config": checkpoint or copy.deepcopy(self.config),
+            "maze": self.game.maze,
+            "agents": {
+                name: {
+                    "coord": agent.coord,
+                    "path": agent.path,
+                    "status": self.agent_status[name],
+                    "index": agent.associate.index.get_state(),
+                }
+                for name, agent in self.game.agents.items()
+            },
+        }
+        with self.game.maze.lock:
+            data = pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        self.snapshot_step = self.config["step"]
+        self.submit(write_snapshot, f"{self.checkpoints_folder}/resume.pkl", data)
+        self.save_manifest()
+
+    # 清單記錄最新的存檔、其完整存檔起的存檔鏈及恢复快照，用於O(1)找到最新存檔
+    def save_manifest(self):
+        manifest = {
+            "step": self.config["step"],
+            "time": self.config["time"],
+            "checkpoints": list(self.keyframe_chain),
+            "snapshot": "resume.pkl" if self.snapshot_step else None,
+            "snapshot_step": self.snapshot_step,
+        }
+        self.submit(utils.save_manifest, self.checkpoints_folder, manifest)
+
+    def submit(self, func, *args):
+        if self.writer:
+            self.writer.submit(func, *args)
+        else:
+            func(*args)
+
+    # 寫入SQLite存儲所需的存檔文件、完整存檔文件與該步的對話
+    def store_step(self, checkpoint_file, sim_time):
+        chats = list(self.game.conversation.get(sim_time, []))
+        return os.path.basename(checkpoint_file), self.keyframe_file, chats
 
-            if stride > 0:
-                timer.forward(stride)
+    # 事件模式：跳到下一個Agent行動或日程變化的時間（stride的整數倍，至少一個stride）
+    def next_forward(self, stride):
+        timer = utils.get_timer()
+        next_time = min(a.next_event() for a in self.game.agents.values())
+        minutes = int((next_time - timer.get_date()).total_seconds() // 60)
+        forward = max(stride, minutes // stride * stride)
+        if forward > stride:
+            self.logger.info(
+                "Forward {} minutes to {}".format(forward, next_time.strftime("%Y%m%d-%H:%M"))
+            )
+        return forward
+
+    # 所有Agent思考一步，並行模式下不同Agent的思考同時進行
+    def think(self, executor=None):
+        if self.shards > 1:
+            return self.game.think(self.agent_status)
+        if executor is None:
+            return {
+                name: self.game.agent_think(name, status)
+                for name, status in self.agent_status.items()
+            }
+        # 並行思考時對其他Agent的反應（對話、等待）先記錄下來，所有Agent思考完成後再執行
+        futures = {
+            name: executor.submit(self.game.agent_think, name, status, True)
+            for name, status in self.agent_status.items()
+        }
+        results = {name: future.result() for name, future in futures.items()}
+        return self.game.react(results, executor)
 
     def load_static(self, path):
         return utils.load_dict(os.path.join(self.static_root, path))
 
 
-# 從存檔數據總載入配置，用於斷點恢复
-def get_config_from_log(checkpoints_folder):
-    files = sorted(os.listdir(checkpoints_folder))
+def write_snapshot(path, data):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
 
-    json_files = list()
-    for file_name in files:
-        if file_name.endswith(".json") and file_name != "conversation.json":
-            json_files.append(os.path.join(checkpoints_folder, file_name))
 
-    if len(json_files) < 1:
+# 載入恢复快照，僅當快照對應最新存檔時可用
+def load_snapshot(checkpoints_folder):
+    manifest = utils.load_manifest(checkpoints_folder)
+    if not manifest or not manifest.get("snapshot") or manifest["snapshot_step"] != manifest["step"]:
+        return None
+    path = os.path.join(checkpoints_folder, manifest["snapshot"])
+    if not os.path.exists(path):
         return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
 
-    with open(json_files[-1], "r", encoding="utf-8") as f:
-        config = json.load(f)
+
+# 從存檔數據總載入配置，用於斷點恢复
+def get_config_from_log(checkpoints_folder, snapshot=None):
+    if snapshot:
+        config = snapshot["config"]
+    else:
+        # 最後一個存檔可能是差異存檔，需從最近的完整存檔恢复，清單或SQLite存儲中記錄了存檔鏈
+        files = None
+        manifest = utils.load_manifest(checkpoints_folder)
+        store = open_run_store(checkpoints_folder)
+        if manifest:
+            files = [os.path.join(checkpoints_folder, f) for f in manifest["checkpoints"]]
+        elif store:
+            files = store.checkpoint_files()
+        if store:
+            store.close()
+        config = utils.load_checkpoint(checkpoints_folder, files=files)
+    if config is None:
+        return None
 
     assets_root = os.path.join("assets", "village")
 
     start_time = datetime.datetime.strptime(config["time"], "%Y%m%d-%H:%M")
-    start_time += datetime.timedelta(minutes=config["stride"])
+    start_time += datetime.timedelta(minutes=config.get("forward", config["stride"]))
     config["time"] = {"start": start_time.strftime("%Y%m%d-%H:%M")}
     agents = config["agents"]
     for a in agents:
@@ -142,6 +332,7 @@ def get_config(start_time="20240213-09:30", stride=15, agents=None):
         "maze": {"path": os.path.join(assets_root, "maze.json")},
         "agent_base": agent_config,
         "agents": {},
+        "simulate": json_data.get("simulate", {}),
         "api_keys": json_data["api_keys"],
     }
     for a in agents:
@@ -161,6 +352,10 @@ parser.add_argument("--start", type=str, default="20240213-09:30", help="The sta
 parser.add_argument("--resume", action="store_true", help="Resume running the simulation")
 parser.add_argument("--step", type=int, default=10, help="The simulate step")
 parser.add_argument("--stride", type=int, default=10, help="The step stride in minute")
+parser.add_argument("--mode", type=str, default="stride", choices=["stride", "event"], help="The time advance mode, 'event' jumps to the next action or schedule change")
+parser.add_argument("--cassette", type=str, default="", choices=["", "off", "record", "replay"], help="Record or replay the LLM and embedding calls")
+parser.add_argument("--cassette_path", type=str, default="", help="The cassette file for recording or replaying")
+parser.add_argument("--seed", type=int, default=None, help="The random seed, fix it to replay a cassette deterministically")
 parser.add_argument("--verbose", type=str, default="debug", help="The verbose level")
 parser.add_argument("--log", type=str, default="", help="Name of the log file")
 args = parser.parse_args()
@@ -184,8 +379,10 @@ if __name__ == "__main__":
     checkpoints_folder = f"{checkpoints_path}/{name}"
 
     start_time = args.start
+    snapshot = None
     if resume:
-        sim_config = get_config_from_log(checkpoints_folder)
+        snapshot = load_snapshot(checkpoints_folder)
+        sim_config = get_config_from_log(checkpoints_folder, snapshot)
         if sim_config is None:
             print("No checkpoint file found to resume running.")
             exit(0)
@@ -194,7 +391,18 @@ if __name__ == "__main__":
         sim_config = get_config(start_time, args.stride, personas)
         start_step = 0
 
+    # 錄製/回放LLM與embedding調用（用於離線重現模擬）
+    if args.cassette or args.cassette_path:
+        cassette = sim_config.setdefault("simulate", {}).setdefault("cassette", {})
+        if args.cassette:
+            cassette["mode"] = args.cassette
+        if args.cassette_path:
+            cassette["path"] = args.cassette_path
+
+    if args.seed is not None:
+        sim_config.setdefault("simulate", {})["seed"] = args.seed
+
     static_root = "frontend/static"
 
-    server = SimulateServer(name, static_root, checkpoints_folder, sim_config, start_step, args.verbose, args.log)
-    server.simulate(args.step, args.stride)
+    server = SimulateServer(name, static_root, checkpoints_folder, sim_config, start_step, args.verbose, args.log, snapshot)
+    server.simulate(args.step, args.stride, args.mode)
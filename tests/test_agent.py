@@ -0,0 +1,26 @@
+"""generative_agents.tests.test_agent"""
+
+from modules import memory, utils
+from modules.agent import Agent
+
+
+def create_agent(plan_path):
+    utils.set_timer("20240213-09:30")
+    agent = Agent.__new__(Agent)
+    agent.path, agent.plan = [], {"path": plan_path}
+    event = memory.Event("甲", "此時", "寫作", address=["the Ville", "house", "desk"])
+    agent.action = memory.Action(event, duration=60)
+    agent.schedule = memory.Schedule(create=utils.get_timer().get_date())
+    agent.schedule.add_plan("寫作", 24 * 60)
+    return agent
+
+
+def test_next_event_of_settled_agent():
+    agent = create_agent([])
+    assert agent.next_event() == agent.action.end
+
+
+def test_next_event_of_walking_agent():
+    agent = create_agent([[10, 20], [10, 21], [11, 21]])
+    # the walk is not skipped by jumping to the end of the action
+    assert agent.next_event() == utils.get_timer().get_date()
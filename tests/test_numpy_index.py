@@ -0,0 +1,66 @@
+"""generative_agents.tests.test_numpy_index"""
+
+import numpy as np
+import pytest
+from llama_index.core.vector_stores import (
+    ExactMatchFilter,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+
+from modules.storage.numpy_index import NumpyIndex, VectorNode
+
+
+def create_index():
+    index = NumpyIndex.__new__(NumpyIndex)
+    index._partitions, index._rows, index._ann, index._expiry = {}, {}, {}, None
+    index._precision, index._rerank = "float32", 0
+    nodes = [
+        VectorNode.from_metadata(
+            "node_" + str(i),
+            "事" + str(i),
+            {
+                "node_type": "event",
+                "address": "the Ville:house" if i % 2 else "the Ville:cafe",
+                "create": "20240213-09:30:00",
+                "expire": "20240214-09:30:00",
+                "access": "20240213-09:30:00",
+                "poignancy": i,
+            },
+        )
+        for i in range(4)
+    ]
+    index._insert(nodes, np.eye(4, dtype=np.float32))
+    return index
+
+
+def match(index, node_type, *filters):
+    rows = np.arange(len(index._partitions[node_type].ids))
+    rows = index._match_filters(node_type, rows, MetadataFilters(filters=list(filters)))
+    return [index._partitions[node_type].ids[r] for r in rows]
+
+
+def test_match_node_type():
+    index = create_index()
+    assert match(index, "event", ExactMatchFilter(key="node_type", value="event")) == [
+        "node_0",
+        "node_1",
+        "node_2",
+        "node_3",
+    ]
+    assert match(index, "event", ExactMatchFilter(key="node_type", value="chat")) == []
+
+
+def test_match_metadata():
+    index = create_index()
+    address = ExactMatchFilter(key="address", value="the Ville:house")
+    assert match(index, "event", address) == ["node_1", "node_3"]
+    poignancy = ExactMatchFilter(key="poignancy", value=3)
+    assert match(index, "event", address, poignancy) == ["node_3"]
+
+
+def test_unsupported_operator():
+    index = create_index()
+    with pytest.raises(NotImplementedError):
+        match(index, "event", MetadataFilter(key="poignancy", value=2, operator=FilterOperator.GT))
@@ -0,0 +1,21 @@
+"""generative_agents.tests.test_quantize"""
+
+import numpy as np
+import pytest
+
+from modules.storage.quantize import QuantizedVectors
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+def test_dot_in_chunks(precision):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((600, 32)).astype(np.float32)
+    queries = rng.standard_normal((3, 32)).astype(np.float32)
+    stored = QuantizedVectors.create(precision)
+    stored.append(vectors)
+    stored.remove(10)
+    rows = np.arange(len(stored))
+    expected = stored[rows] @ queries.T
+    # rows span several chunks and include the moved last row
+    assert np.allclose(stored.dot(rows, queries, chunk=256), expected, atol=1e-4)
+    assert stored.dot(rows[:0], queries).shape == (0, 3)
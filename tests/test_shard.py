@@ -0,0 +1,55 @@
+"""generative_agents.tests.test_shard"""
+
+import threading
+import types
+import multiprocessing
+
+from modules import memory, utils
+from modules.agent import Agent
+from modules.shard import RemoteAgent, ShardBroker, agent_state
+
+
+def create_agent(name):
+    agent = Agent.__new__(Agent)
+    agent.name, agent.lock = name, threading.RLock()
+    agent.coord, agent.path, agent.plan, agent.chats = [10, 20], [], {"path": []}, []
+    agent.think_config = {"interval": 10}
+    event = memory.Event(name, "此時", "寫作", address=["the Ville", "house", "desk"])
+    agent.action = memory.Action(event, duration=60)
+    agent.schedule = memory.Schedule(create=utils.get_timer().get_date())
+    agent.schedule.add_plan("寫作", 24 * 60)
+    return agent
+
+
+def create_shards():
+    """Two shards, the first owns 甲 and 乙, the second holds a proxy of 甲"""
+
+    utils.set_timer("20240213-09:30")
+    owner = {n: create_agent(n) for n in ("甲", "乙")}
+    game = types.SimpleNamespace(agents=owner, get_agent=owner.get)
+    conn, peer_conn = multiprocessing.Pipe()
+    ShardBroker(conn, game, utils.IOLogger())
+    broker = ShardBroker(peer_conn, types.SimpleNamespace(agents={}), utils.IOLogger())
+    return owner, RemoteAgent(agent_state(owner["甲"]), None, broker)
+
+
+def test_remote_lock_queries_state():
+    owner, proxy = create_shards()
+    # another reaction of the owner shard revises the action after the state is shipped
+    event = memory.Event("甲", "對話", "乙", address=["the Ville", "house", "desk"])
+    owner["甲"].action = memory.Action(event, duration=10)
+    assert proxy.get_event().predicate == "此時"
+    with proxy.lock:
+        assert proxy.get_event().predicate == "對話"
+        assert not owner["甲"].lock.acquire(blocking=False)
+
+
+def test_remote_chat_updates_proxy():
+    owner, proxy = create_shards()
+    with proxy.lock:
+        proxy.schedule_chat(
+            [("乙", "你好")], "問好", utils.get_timer().get_date(), 10, owner["乙"],
+            address=["the Ville", "house", "desk"],
+        )
+        assert proxy.get_event().fit(predicate="對話")
+    assert owner["甲"].get_event().fit(predicate="對話")